@@ -1106,7 +1106,7 @@ class CyberBattleEnv(gym.Env):
         if isinstance(outcome, model.DetectionPoint):
             logger.info(f"or WARNING (hidden from agent): detection point {outcome.detection_point_name} triggered on step={self.__stepcount}!")
             if outcome.detection_point_name in self.__deception_tracker.keys():
-                self.__deception_tracker[outcome.detection_point_name].trigger_times += [self.__stepcount]
+                self.__deception_tracker[outcome.detection_point_name].trigger(self.__stepcount)
             else:
                 self.__deception_tracker[outcome.detection_point_name] = model.DeceptionTracker(outcome.detection_point_name, step=self.__stepcount)
 
@@ -1388,7 +1388,7 @@ class CyberBattleEnv(gym.Env):
             duration_in_ms=duration,
             step_count=self.__stepcount,
             network_availability=self._defender_actuator.network_availability,
-            precondition_str=result.precondition if isinstance(result.precondition, str) else str(result.precondition.expression),
+            precondition_str=result.precondition if isinstance(result.precondition, str) else result.precondition.expression_str,
             profile_str=result.profile,
             reward_string=result.reward_string)
 
@@ -271,6 +271,14 @@ class DeepQLearnerPolicy(Learner):
         return f'γ={self.gamma}, lr={self.learning_rate}, replaymemory={self.memory.capacity},\n' \
                f'batch={self.batch_size}, target_update={self.target_update}, reward_clip={1 if self.reward_clip else 0}'
 
+    def hparams_dict(self):
+        return {'gamma': self.gamma,
+                'lr': self.learning_rate,
+                'replay_memory_size': self.memory.capacity,
+                'batch': self.batch_size,
+                'target_update': self.target_update,
+                'reward_clip': 1 if self.reward_clip else 0}
+
     def all_parameters_as_string(self) -> str:
         model = self.stateaction_model
         return f'{self.parameters_as_string()}\n' \
@@ -387,13 +395,13 @@ class DeepQLearnerPolicy(Learner):
         """ Given a set of possible current states return:
             - index, in the provided list, of the state that would yield the best possible outcome
             - the best action to take in such a state"""
-        with torch.no_grad():
+        with torch.inference_mode():
             # t.max(1) will return largest column value of each row.
             # second column on max result is index of where max element was
             # found, so we pick action with the larger expected reward.
             # action: np.int32 = self.policy_net(states_to_consider).max(1)[1].view(1, 1).item()
 
-            state_batch = torch.tensor(states_to_consider).to(device)
+            state_batch = torch.as_tensor(states_to_consider, device=device)
             dnn_output = self.policy_net(state_batch).max(1)
             action_lookups = dnn_output[1].tolist()
             expectedq_lookups = dnn_output[0].tolist()
@@ -468,12 +476,14 @@ class DeepQLearnerPolicy(Learner):
             for from_node in w.owned_nodes(observation)
         ]
 
-        unique_active_actors_features: List[ndarray] = list(np.unique(active_actors_features, axis=0))
+        unique_active_actors_features: ndarray = np.unique(active_actors_features, axis=0)
 
-        # array of actor state vector for every possible set of node features
-        candidate_actor_state_vector: ndarray = np.array([
-            self.get_actor_state_vector(current_global_state, node_features)
-            for node_features in unique_active_actors_features])
+        # array of actor state vector for every possible set of node features,
+        # built as one batch so that a single DQN forward scores all candidates
+        global_state_batch = np.broadcast_to(np.asarray(current_global_state, dtype=np.float32),
+                                             (len(unique_active_actors_features), len(current_global_state)))
+        candidate_actor_state_vector: ndarray = np.hstack(
+            (global_state_batch, unique_active_actors_features.astype(np.float32)))
 
         remaining_action_lookups, remaining_expectedq_lookups = self.lookup_dqn(candidate_actor_state_vector)
         remaining_candidate_indices = list(range(len(candidate_actor_state_vector)))
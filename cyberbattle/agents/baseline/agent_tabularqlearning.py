@@ -414,6 +414,11 @@ class QTabularLearner(learner.Learner):
                f"learning_rate={self.learning_rate},"\
                f"Q%={self.exploit_percentile}"
 
+    def hparams_dict(self):
+        return {'gamma': self.gamma,
+                'learning_rate': self.learning_rate,
+                'Q%': self.exploit_percentile}
+
     def all_parameters_as_string(self) -> str:
         return f' dimension={self.qsource.state_space.flat_size()}x{self.qsource.action_space.flat_size()},' \
             f'{self.qattack.state_space.flat_size()}x{self.qattack.action_space.flat_size()}\n' \
@@ -1,11 +1,21 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-"""Learner helpers and epsilon greedy search"""
+"""Learner helpers and epsilon greedy search
+
+The step loops below are bound by Python object handling (learner calls,
+dictionary lookups and environment bookkeeping), not by arithmetic. Per-step
+records are therefore kept in preallocated numpy buffers reused across
+episodes; vectorization or GPU offloading of the bookkeeping would not pay off.
+"""
+import collections
+import concurrent.futures
 import math
 import sys
 import os
 import re
+import shutil
+import time
 
 from .plotting import PlotTraining, plot_averaged_cummulative_rewards
 from .agent_wrapper import AgentWrapper, EnvironmentBounds, Verbosity, ActionTrackingStateAugmentation
@@ -14,7 +24,8 @@ import numpy as np
 import torch
 import random
 from cyberbattle._env import cyberbattle_env
-from typing import Tuple, Optional, TypedDict, List
+from dataclasses import dataclass
+from typing import Dict, Tuple, Optional, TypedDict, List, Union
 import progressbar
 import abc
 from torch.utils.tensorboard.summary import hparams
@@ -65,6 +76,10 @@ class Learner(abc.ABC):
     def parameters_as_string(self) -> str:
         return ''
 
+    def hparams_dict(self) -> Dict[str, Union[float, int]]:
+        """Return the learner hyperparameters logged to TensorBoard"""
+        return {}
+
     def all_parameters_as_string(self) -> str:
         return ''
 
@@ -112,6 +127,228 @@ Stats = TypedDict('Stats', {
     'exploit_deflected_to_explore': int
 })
 
+# axes of the per-episode stats counters: [action style, outcome, action kind]
+STATS_ACTION_STYLES = ('exploit', 'explore')
+STATS_OUTCOMES = ('reward', 'noreward')
+STATS_KINDS = ('local', 'remote', 'connect')
+
+
+# index along the last stats axis for each gym action kind
+ACTION_KIND_INDEX = {'local_vulnerability': 0, 'remote_vulnerability': 1, 'connect': 2}
+
+
+def action_kind_index(gym_action: cyberbattle_env.Action) -> int:
+    """Return the stats kind index of a gym action (a dictionary with a single action-kind key)"""
+    return ACTION_KIND_INDEX[next(iter(gym_action))]
+
+
+@dataclass
+class EpisodeBuffers:
+    """Per-episode step records, allocated once per search and reused across episodes"""
+    # outcome counters indexed by [action style, outcome, action kind]
+    stats_counts: np.ndarray
+    # reward and network availability of each step, valid up to the episode length
+    rewards: np.ndarray
+    availability: np.ndarray
+    exploit_deflected_to_explore: int = 0
+
+    @staticmethod
+    def allocate(iteration_count: int) -> 'EpisodeBuffers':
+        return EpisodeBuffers(
+            stats_counts=np.zeros((len(STATS_ACTION_STYLES), len(STATS_OUTCOMES), len(STATS_KINDS)), dtype=np.int64),
+            rewards=np.empty(iteration_count, dtype=np.float64),
+            availability=np.empty(iteration_count, dtype=np.float64))
+
+    @property
+    def rewarded_step_count(self) -> int:
+        """Number of steps with a positive reward in the current episode"""
+        return int(self.stats_counts[:, STATS_OUTCOMES.index('reward')].sum())
+
+    def reset(self) -> None:
+        """Clear the counters at the start of an episode (step buffers are overwritten in place)"""
+        self.stats_counts.fill(0)
+        self.exploit_deflected_to_explore = 0
+
+    def record(self, t: int, reward: float, availability: float, action_style: str, gym_action: cyberbattle_env.Action) -> None:
+        """Record the outcome of step `t` (1-based)"""
+        self.stats_counts[0 if action_style == 'exploit' else 1, 0 if reward > 0 else 1, action_kind_index(gym_action)] += 1
+        self.rewards[t - 1] = reward
+        self.availability[t - 1] = availability
+
+
+class _GrowableArray:
+    """1-D numpy array with amortized O(1) appends, doubling its capacity when full"""
+
+    def __init__(self, dtype, capacity: int = 64):
+        self._buffer = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def _reserve(self, size: int) -> None:
+        capacity = len(self._buffer)
+        if size > capacity:
+            while capacity < size:
+                capacity *= 2
+            self._buffer = np.resize(self._buffer, capacity)
+
+    def append(self, value) -> None:
+        self._reserve(self.size + 1)
+        self._buffer[self.size] = value
+        self.size += 1
+
+    def extend(self, values) -> None:
+        end = self.size + len(values)
+        self._reserve(end)
+        self._buffer[self.size:end] = values
+        self.size = end
+
+    def view(self, start: int = 0) -> np.ndarray:
+        """Return the values from `start` on, without copying"""
+        return self._buffer[start:self.size]
+
+
+class DetectionPointsBuffer:
+    """Steps at which a detection point was triggered, stored per episode in CSR layout.
+
+    The trigger steps of episode `i` are `indices[indptr[i]:indptr[i + 1]]` and
+    the episode length is `eplength[i]`."""
+
+    def __init__(self):
+        self._indices = _GrowableArray(np.int32)
+        self._indptr = _GrowableArray(np.int64)
+        self._indptr.append(0)
+        self._eplength = _GrowableArray(np.int32)
+        # counts at the previous call to `take_checkpoint`
+        self._checkpoint_trigger_count = 0
+        self._checkpoint_episode_count = 0
+
+    @property
+    def trigger_count(self) -> int:
+        return self._indices.size
+
+    @property
+    def episode_count(self) -> int:
+        return self._eplength.size
+
+    def append_episode(self, trigger_times: Union[List[int], np.ndarray], episode_length: int) -> None:
+        """Record the trigger steps and the length of a finished episode"""
+        self._indices.extend(trigger_times)
+        self._indptr.append(self._indices.size)
+        self._eplength.append(episode_length)
+
+    @property
+    def new_trigger_count(self) -> int:
+        """Number of triggers appended since the previous checkpoint"""
+        return self.trigger_count - self._checkpoint_trigger_count
+
+    def take_checkpoint(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return (indices, indptr, eplength) of the episodes appended since the previous checkpoint,
+        with indptr rebased to start at 0, and mark them as checkpointed"""
+        trigger_start, episode_start = self._checkpoint_trigger_count, self._checkpoint_episode_count
+        delta = (self._indices.view(trigger_start),
+                 self._indptr.view(episode_start) - trigger_start,
+                 self._eplength.view(episode_start))
+        self._checkpoint_trigger_count, self._checkpoint_episode_count = self.trigger_count, self.episode_count
+        return delta
+
+    @property
+    def indices(self) -> np.ndarray:
+        return self._indices.view()
+
+    @property
+    def indptr(self) -> np.ndarray:
+        return self._indptr.view()
+
+    @property
+    def eplength(self) -> np.ndarray:
+        return self._eplength.view()
+
+
+def append_detection_points(detection_points_results: Dict[str, DetectionPointsBuffer], deception_tracker, episode_length: int) -> None:
+    """Append the trigger steps of each detection point at the end of an episode"""
+    for name, tracker in deception_tracker.items():
+        if name not in detection_points_results:
+            detection_points_results[name] = DetectionPointsBuffer()
+        detection_points_results[name].append_episode(np.frombuffer(tracker.trigger_times, dtype=np.int64), episode_length)
+
+
+DETECTION_POINTS_SUFFIXES = ('_indices', '_indptr', '_eplength')
+
+
+def detection_points_payload(arrays: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Flatten (indices, indptr, eplength) arrays per detection point into the `<name><suffix>` keys of the result files"""
+    payload = {}
+    for name, streams in arrays.items():
+        for suffix, stream in zip(DETECTION_POINTS_SUFFIXES, streams):
+            payload[name + suffix] = stream
+    return payload
+
+
+def save_detection_points(path: str, detection_points_results: Dict[str, DetectionPointsBuffer]) -> None:
+    """Save the detection point results to an npz file with `<name>_indices`, `<name>_indptr` and `<name>_eplength` arrays"""
+    np.savez(path, **detection_points_payload({name: (v.indices, v.indptr, v.eplength)
+                                               for name, v in detection_points_results.items()}))
+
+
+DETECTION_DUMP_FORMATS = ('npz', 'npz_compressed', 'npy_dir')
+
+
+def dump_detection_points(path: str, payload: Dict[str, np.ndarray], dump_format: str = 'npz') -> str:
+    """Write a detection point payload to `path` (without extension) in one of `DETECTION_DUMP_FORMATS`
+    and return the name of the written file or directory"""
+    if dump_format == 'npz':
+        np.savez(path + '.npz', **payload)
+        return path + '.npz'
+    elif dump_format == 'npz_compressed':
+        np.savez_compressed(path + '.npz', **payload)
+        return path + '.npz'
+    elif dump_format == 'npy_dir':
+        os.makedirs(path, exist_ok=True)
+        for key, array in payload.items():
+            np.save(os.path.join(path, key + '.npy'), array)
+        return path
+    raise ValueError(f"Unknown detection points dump format {dump_format}, expected one of {DETECTION_DUMP_FORMATS}")
+
+
+def load_detection_points(path: str) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Load a file written by `save_detection_points` or `dump_detection_points` as a dictionary
+    mapping each detection point name to its (indices, indptr, eplength) arrays"""
+    def split(data):
+        names = [key[:-len('_indices')] for key in data if key.endswith('_indices')]
+        return {name: tuple(data[name + suffix] for suffix in DETECTION_POINTS_SUFFIXES) for name in names}
+
+    if os.path.isdir(path):
+        return split({key[:-len('.npy')]: np.load(os.path.join(path, key)) for key in os.listdir(path) if key.endswith('.npy')})
+    with np.load(path) as data:
+        return split(data)
+
+
+DETECTION_POINTS_CHECKPOINT = re.compile(r'detection_points_results_delta_e(\d+)(\.npz)?')
+
+
+def reassemble_detection_points(training_dir: str) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Concatenate the periodic `detection_points_results_delta_e{N}` checkpoints of a training directory,
+    in episode order, into the (indices, indptr, eplength) arrays of all the checkpointed episodes"""
+    checkpoints = []
+    for entry in os.listdir(training_dir):
+        match = DETECTION_POINTS_CHECKPOINT.fullmatch(entry)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(training_dir, entry)))
+
+    parts: Dict[str, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = {}
+    for _, path in sorted(checkpoints):
+        for name, streams in load_detection_points(path).items():
+            parts.setdefault(name, []).append(streams)
+
+    results = {}
+    for name, streams in parts.items():
+        # each checkpoint indptr starts at 0, shift it by the triggers of the previous checkpoints
+        offsets = np.cumsum([0] + [len(indices) for indices, _, _ in streams])
+        results[name] = (np.concatenate([indices for indices, _, _ in streams]),
+                         np.concatenate([[0]] + [indptr[1:] + offset for (_, indptr, _), offset in zip(streams, offsets)]),
+                         np.concatenate([eplength for _, _, eplength in streams]))
+    return results
+
+
 TrainedLearner = TypedDict('TrainedLearner', {
     'all_episodes_rewards': List[List[float]],
     'all_episodes_availability': List[List[float]],
@@ -122,26 +359,32 @@ TrainedLearner = TypedDict('TrainedLearner', {
 })
 
 
-def write_to_summary(writer, all_rewards, epsilon, loss_string, observation, iteration_count, run_mean, steps_done, writer_tag="training"):
+# minimum delay in seconds between two redraws of the training progress bar
+PROGRESSBAR_MIN_POLL_INTERVAL = 0.5
+
+_NON_ALPHANUMERIC = re.compile(r'[^a-zA-Z0-9]')
+
+
+def write_to_summary(writer, total_reward, n_positive_actions, epsilon, loss_string, observation, iteration_count, run_mean, steps_done,
+                     writer_tag="training"):
     """
-    all_rewards: - (training case) list of rewards per episode; (evaluation case) list of sum of rewards during episode
+    total_reward: sum of rewards during the episode
+    n_positive_actions: number of steps of the episode with a positive reward
     """
 
     is_training = writer_tag == "training"
 
-    total_reward = sum(all_rewards)
     # TODO: make higher verbosity level
     # writer.add_histogram(writer_tag + "/rewards", all_rewards, steps_done)
     writer.add_scalar(writer_tag + "/epsilon", epsilon, steps_done) if is_training else ''
-    writer.add_scalar("loss", float(re.sub(r'[^a-zA-Z0-9]', '', loss_string.split("=")[-1])), steps_done) if is_training and loss_string else ''
+    writer.add_scalar("loss", float(_NON_ALPHANUMERIC.sub('', loss_string.split("=")[-1])), steps_done) if is_training and loss_string else ''
 
-    n_positive_actions = np.sum(np.array(all_rewards) > 0)
     writer.add_scalar(writer_tag + "/n_positive_actions", n_positive_actions, steps_done)
     writer.add_scalar("total_reward", total_reward, steps_done) if is_training else ''
     writer.add_scalar(writer_tag + "/total_reward", total_reward, steps_done) if not is_training else ''
     # writer.add_text(writer_tag + "/deception_tracker", str({k: v.trigger_times for k, v in observation['_deception_tracker'].items()}), steps_done)
     for k, v in observation['_deception_tracker'].items():
-        writer.add_scalar(writer_tag + "/detection_points_trigger_counter/" + k, len(v.trigger_times), steps_done)
+        writer.add_scalar(writer_tag + "/detection_points_trigger_counter/" + k, v.trigger_count, steps_done)
         # writer.add_histogram(writer_tag + "/detection_points_trigger_steps/" + k,
         #                      np.array(v.trigger_times), steps_done, bins=iteration_count) if len(v.trigger_times) else ''
     # triggers = [v.trigger_times for _, v in observation['_deception_tracker'].items()]
@@ -152,7 +395,50 @@ def write_to_summary(writer, all_rewards, epsilon, loss_string, observation, ite
     else:
         writer.add_scalar("eval_run_mean", run_mean, steps_done)
 
-    writer.flush()
+
+def write_hparams(writer, hparams_dict: Dict[str, object]) -> None:
+    """Write the hyperparameters of a training run to TensorBoard"""
+    hparam_domain_discrete = {}
+    if 'gamma' in hparams_dict:
+        hparam_domain_discrete["gamma"] = [0.015, 0.25, 0.5, 0.8]
+    if 'train_while_exploit' in hparams_dict:
+        hparam_domain_discrete["train_while_exploit"] = [0, 1]
+    if 'reward_clip' in hparams_dict:
+        hparam_domain_discrete["reward_clip"] = [0, 1]
+
+    exp, ssi, sei = hparams(hparams_dict,
+                            metric_dict={"run_mean": -3000,
+                                         "eval_run_mean": -3000,
+                                         "loss": sys.float_info.max,
+                                         "total_reward": -3000,
+                                         },
+                            hparam_domain_discrete=hparam_domain_discrete)
+    writer.file_writer.add_summary(exp)
+    writer.file_writer.add_summary(ssi)
+    writer.file_writer.add_summary(sei)
+
+
+def link_file(source: str, destination: str) -> None:
+    """Make `destination` a hard link to `source` (a copy if links are unsupported).
+    The link is made under a temporary name then renamed, so that `destination` is replaced atomically
+    and later writes to it never go through to `source`"""
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    tmp_filename = destination + '.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    try:
+        os.link(source, tmp_filename)
+    except OSError:
+        shutil.copy2(source, tmp_filename)
+    os.replace(tmp_filename, destination)
+
+
+def save_checkpoint(learner: Learner, versioned_filename: str, best_filename: str) -> None:
+    """Save the learner once to `versioned_filename` and make `best_filename` a link to it"""
+    learner.save(versioned_filename)
+    if os.path.exists(versioned_filename):
+        link_file(versioned_filename, best_filename)
 
 
 def print_stats(stats):
@@ -180,6 +466,17 @@ def print_stats(stats):
     print(f"  exploit deflected to exploration: {stats['exploit_deflected_to_explore']}")
 
 
+def print_stats_counts(stats_counts: np.ndarray, exploit_deflected_to_explore: int):
+    """Print learning statistics from a [action style, outcome, action kind] counter array"""
+    print("  Breakdown [Reward/NoReward (Success rate)]")
+    for actiontype in ('explore', 'exploit'):
+        reward_counts, noreward_counts = stats_counts[STATS_ACTION_STYLES.index(actiontype)]
+        for kind, x, y in zip(STATS_KINDS, reward_counts, noreward_counts):
+            ratio = 'NaN' if x + y == 0 else f"{(x / (x + y)):.2f}"
+            print(f"    {actiontype}-{kind}: {x}/{y} ({ratio})")
+    print(f"  exploit deflected to exploration: {exploit_deflected_to_explore}")
+
+
 def evaluate_model(
     cyberbattle_gym_env: cyberbattle_env.CyberBattleEnv,
     environment_properties: EnvironmentBounds,
@@ -210,11 +507,14 @@ def evaluate_model(
     initial_epsilon = epsilon
 
     all_episodes_rewards = []
-    all_episodes_sum_rewards = []
+    # sums of rewards of the last mean_reward_window episodes and their running total
+    reward_window = collections.deque(maxlen=mean_reward_window)
+    reward_window_sum = 0.0
     all_episodes_availability = []
 
-    wrapped_env = AgentWrapper(cyberbattle_gym_env,
-                               ActionTrackingStateAugmentation(environment_properties, cyberbattle_gym_env.reset()))
+    # the state augmentation gets its first observation from the reset at the start of each episode
+    wrapped_env = AgentWrapper(cyberbattle_gym_env, ActionTrackingStateAugmentation(environment_properties))
+    buffers = EpisodeBuffers.allocate(iteration_count)
     steps_done = 0
 
     plot_title = f"{title} (epochs={eval_episode_count}, ϵ={initial_epsilon}" + learner.parameters_as_string()
@@ -222,8 +522,11 @@ def evaluate_model(
     render_file_index = 1
     learner.eval()
 
-    if configuration.log_results:
-        detection_points_results = {}
+    record_detection_points = (not training_episode_done % (5 * eval_freq)) and configuration.log_results
+    detection_points_results: Dict[str, DetectionPointsBuffer] = {}
+
+    print_all_steps = verbosity == Verbosity.Verbose
+    print_rewarded_steps = verbosity == Verbosity.Normal
 
     for i_episode in range(1, eval_episode_count + 1):
 
@@ -233,17 +536,9 @@ def evaluate_model(
 
         observation = wrapped_env.reset()
         total_reward = 0.0
-        all_rewards = []
-        all_availability = []
+        buffers.reset()
         learner.new_episode()
 
-        stats = Stats(exploit=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
-                                       noreward=Breakdown(local=0, remote=0, connect=0)),
-                      explore=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
-                                       noreward=Breakdown(local=0, remote=0, connect=0)),
-                      exploit_deflected_to_explore=0
-                      )
-
         episode_ended_at = None
         sys.stdout.flush()
 
@@ -257,33 +552,23 @@ def evaluate_model(
             # else:
             action_style, gym_action, action_metadata = learner.exploit(wrapped_env, observation)
             if not gym_action:
-                stats['exploit_deflected_to_explore'] += 1
+                buffers.exploit_deflected_to_explore += 1
                 _, gym_action, action_metadata = learner.explore(wrapped_env)  # TODO: evaluation - exclude gym_aciton is None due to 1) NN no candidates 2)  > n_discovered_nodes, > n_credential_cache
 
             # Take the step
             # logger.debug(f"gym_action={gym_action}, action_metadata={action_metadata}") if configuration.log_results else None
             observation, reward, done, info = wrapped_env.step(gym_action)
 
-            action_type = 'exploit' if action_style == 'exploit' else 'explore'
-            outcome = 'reward' if reward > 0 else 'noreward'
-            if 'local_vulnerability' in gym_action:
-                stats[action_type][outcome]['local'] += 1
-            elif 'remote_vulnerability' in gym_action:
-                stats[action_type][outcome]['remote'] += 1
-            else:
-                stats[action_type][outcome]['connect'] += 1
-
             # learner.on_step(wrapped_env, observation, reward, done, info, action_metadata)
-            assert np.shape(reward) == ()
+            assert isinstance(reward, (int, float, np.number)), f"scalar reward expected, got {type(reward)}"
 
-            all_rewards.append(reward)
-            all_availability.append(info['network_availability'])
+            buffers.record(t, reward, info['network_availability'], action_style, gym_action)
             total_reward += reward
             # bar.update(t, reward=total_reward)
             # if reward > 0:
             # bar.update(t, last_reward_at=t)
 
-            if verbosity == Verbosity.Verbose or (verbosity == Verbosity.Normal and reward > 0):
+            if print_all_steps or (print_rewarded_steps and reward > 0):
                 sign = ['-', '+'][reward > 0]
 
                 print(f"    {sign} t={t} {action_style} r={reward} total_reward:{total_reward} "
@@ -308,16 +593,13 @@ def evaluate_model(
 
         sys.stdout.flush()
 
+        length = episode_ended_at if episode_ended_at else iteration_count
+        all_rewards = buffers.rewards[:length]
+
         loss_string = learner.loss_as_string()
 
-        if (not training_episode_done % (5 * eval_freq)) and configuration.log_results:
-            for name, deception_tracker in observation['_deception_tracker'].items():
-                detection_points_results[name] = detection_points_results.get(name, [[], [0], []])
-                _, name_indptr, _ = detection_points_results[name]
-                # if len(deception_tracker.trigger_times):
-                detection_points_results[name][1] += [name_indptr[-1] + len(deception_tracker.trigger_times)]
-                detection_points_results[name][0] += deception_tracker.trigger_times
-                detection_points_results[name][2] += [episode_ended_at if episode_ended_at else iteration_count]
+        if record_detection_points:
+            append_detection_points(detection_points_results, observation['_deception_tracker'], length)
 
         if loss_string:
             loss_string = f"loss={loss_string}"
@@ -327,38 +609,43 @@ def evaluate_model(
         else:
             print(f"Episode {i_episode} stopped at t={iteration_count} total_reward {total_reward} with {loss_string}")
 
-        print_stats(stats)
+        print_stats_counts(buffers.stats_counts, buffers.exploit_deflected_to_explore)
 
-        all_episodes_sum_rewards.append(sum(all_rewards))
-        all_episodes_rewards.append(all_rewards)
-        all_episodes_availability.append(all_availability)
+        episode_reward = total_reward
+        if len(reward_window) == reward_window.maxlen:
+            reward_window_sum -= reward_window[0]
+        reward_window.append(episode_reward)
+        reward_window_sum += episode_reward
+        all_episodes_rewards.append(all_rewards.tolist())
+        all_episodes_availability.append(buffers.availability[:length].tolist())
 
-        mean_over_window = np.mean(all_episodes_sum_rewards[-mean_reward_window:])
+        mean_over_window = reward_window_sum / len(reward_window)
         if best_eval_running_mean < mean_over_window:
             logger.info(f"New best running mean (eval): {mean_over_window}")
             best_eval_running_mean = mean_over_window
 
             if save_model_filename:
-                learner.save(save_model_filename.replace('.tar', f'_eval_steps{training_steps_done + steps_done}.tar'))
-                learner.save(save_model_filename.replace('.tar', '_eval_best.tar'))
-
-        if (not training_episode_done % (5 * eval_freq)) and configuration.log_results:
-            np.savez(os.path.join(configuration.log_dir, 'training',
-                                  f'detection_points_results_eval_trainsteps{training_steps_done}.npz'),
-                     **({name + '_indices': np.array(v[0]) for name, v in detection_points_results.items()} |
-                        {name + '_indptr': np.array(v[1]) for name, v in detection_points_results.items()} |
-                        {name + '_eplength': np.array(v[2]) for name, v in detection_points_results.items()}))
+                save_checkpoint(learner, save_model_filename.replace('.tar', f'_eval_steps{training_steps_done + steps_done}.tar'),
+                                save_model_filename.replace('.tar', '_eval_best.tar'))
 
         if configuration.log_results:
-            write_to_summary(writer, np.array(all_rewards), epsilon, loss_string, observation, iteration_count, best_eval_running_mean,
-                             training_steps_done + steps_done, writer_tag="evaluation")
-        length = episode_ended_at if episode_ended_at else iteration_count
+            write_to_summary(writer, episode_reward, buffers.rewarded_step_count, epsilon, loss_string, observation, iteration_count,
+                             best_eval_running_mean, training_steps_done + steps_done, writer_tag="evaluation")
         learner.end_of_episode(i_episode=i_episode, t=length)
         # if render:
         #     wrapped_env.render()
 
+    # written once for the whole evaluation rather than re-written after every episode
+    if record_detection_points:
+        save_detection_points(os.path.join(configuration.log_dir, 'training',
+                                           f'detection_points_results_eval_trainsteps{training_steps_done}.npz'),
+                              detection_points_results)
+
     wrapped_env.close()
-    logger.info("evaluation ended\n") if configuration.log_results else None
+    if configuration.log_results:
+        # summaries are written by the SummaryWriter background thread, flush them once per evaluation
+        writer.flush()
+        logger.info("evaluation ended\n")
 
     learner.train()
 
@@ -430,6 +717,15 @@ def epsilon_greedy_search(
     - plot_episodes_length -- Plot the graph showing total number of steps by episode
     at th end of the search.
 
+    Note on experience collection
+    =============================
+
+    Rollouts are collected from a single in-process `AgentWrapper`. Learners
+    read `wrapped_env.state` and `wrapped_env.env` directly when choosing an
+    action and update online in `on_step`, so stepping several environment
+    copies in worker processes would require a batched learner interface.
+    To parallelize, run independent searches (e.g. one per seed) instead.
+
     Note on convergence
     ===================
 
@@ -446,6 +742,8 @@ def epsilon_greedy_search(
     torch.manual_seed(seed)
     random.seed(seed)
     np.random.seed(seed)
+    # dedicated generator for the explore/exploit decisions, the global one stays seeded for learners and environments
+    rng = np.random.default_rng(seed)
 
     writer = configuration.writer
 
@@ -473,39 +771,18 @@ def epsilon_greedy_search(
                         "epsilon_exponential_decay": epsilon_exponential_decay,
                         "train_while_exploit": 0}
 
-        # print(learner.parameters_as_string().replace("γ", "gamma").replace("replaymemory", "replay_memory_size").replace(" ", "").replace("\n", "").split(","))
-
-        hparams_dict.update({param_val.split("=")[0]: float(param_val.split("=")[1]) if len(param_val.split("=")) > 1 and
-                             float(param_val.split("=")[1]) != round(float(param_val.split("=")[1])) else
-                             (int(param_val.split("=")[1]) if len(param_val.split("=")) > 1 else '')
-                            for param_val in learner.parameters_as_string().replace("γ",
-                                                                                    "gamma").replace("replaymemory",
-                                                                                                     "replay_memory_size").replace("\n", "").replace(" ", "").split(",")})
-        hparam_domain_discrete = {}
-        if 'gamma' in hparams_dict:
-            hparam_domain_discrete["gamma"] = [0.015, 0.25, 0.5, 0.8] if '' != hparams_dict.get('gamma', '') else ['']
-        if 'train_while_exploit' in hparams_dict:
-            hparam_domain_discrete["train_while_exploit"] = [0, 1] if '' != hparams_dict.get('train_while_exploit', '') else ['']
-        if 'reward_clip' in hparams_dict:
-            hparam_domain_discrete["reward_clip"] = [0, 1] if '' != hparams_dict.get('reward_clip', '') else ['']
-
-        exp, ssi, sei = hparams(hparams_dict,
-                                metric_dict={"run_mean": -3000,
-                                             "eval_run_mean": -3000,
-                                             "loss": sys.float_info.max,
-                                             "total_reward": -3000,
-                                             },
-                                hparam_domain_discrete=hparam_domain_discrete)
-        writer.file_writer.add_summary(exp)
-        writer.file_writer.add_summary(ssi)
-        writer.file_writer.add_summary(sei)
+        hparams_dict.update(learner.hparams_dict())
+        write_hparams(writer, hparams_dict)
 
     all_episodes_rewards = []
-    all_episodes_sum_rewards = []
+    # sums of rewards of the last mean_reward_window episodes and their running total
+    reward_window = collections.deque(maxlen=mean_reward_window)
+    reward_window_sum = 0.0
     all_episodes_availability = []
 
-    wrapped_env = AgentWrapper(cyberbattle_gym_env,
-                               ActionTrackingStateAugmentation(environment_properties, cyberbattle_gym_env.reset()))
+    # the state augmentation gets its first observation from the reset at the start of each episode
+    wrapped_env = AgentWrapper(cyberbattle_gym_env, ActionTrackingStateAugmentation(environment_properties))
+    buffers = EpisodeBuffers.allocate(iteration_count)
     steps_done = 0
     i_episode = 0
     plot_title = (f"{title} (epochs={episode_count}, ϵ={initial_epsilon}, ϵ_min={epsilon_minimum}," +
@@ -519,10 +796,25 @@ def epsilon_greedy_search(
     best_eval_running_mean = -sys.float_info.max
     # detection_tracker_sparce_matrix = np.zer
 
-    detection_points_results = {}
+    detection_points_results: Dict[str, DetectionPointsBuffer] = {}
+    last_checkpoint_end = time.perf_counter()
+    last_checkpoint_duration = 0.0
+    # periodic checkpoints are written by a single background thread, at most one at a time
+    checkpoint_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending_checkpoint: Optional[concurrent.futures.Future] = None
 
     logger.info('episode_counts ' + str(episode_count))
 
+    log_results = configuration.log_results
+    training_dir = os.path.join(configuration.log_dir, 'training') if log_results else None
+    print_all_steps = verbosity == Verbosity.Verbose
+    print_rewarded_steps = verbosity == Verbosity.Normal
+    # episodes can end early, so the episode count is not known in advance: hoist the schedule constants instead
+    checkpoint_period = 5 * eval_freq
+    if epsilon_exponential_decay:
+        epsilon_decay_rate = -5. / (epsilon_exponential_decay * iteration_count)
+        epsilon_span = initial_epsilon - epsilon_minimum
+
     # for i_episode in range(1, episode_count + 1):
     while steps_done <= episode_count * iteration_count:
         i_episode += 1
@@ -533,20 +825,16 @@ def epsilon_greedy_search(
 
         observation = wrapped_env.reset()
         total_reward = 0.0
-        all_rewards = []
-        all_availability = []
+        buffers.reset()
         learner.new_episode()
 
-        stats = Stats(exploit=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
-                                       noreward=Breakdown(local=0, remote=0, connect=0)),
-                      explore=Outcomes(reward=Breakdown(local=0, remote=0, connect=0),
-                                       noreward=Breakdown(local=0, remote=0, connect=0)),
-                      exploit_deflected_to_explore=0
-                      )
-
         episode_ended_at = None
         sys.stdout.flush()
 
+        if epsilon_exponential_decay:  # the less epsilon_exponential_decay, the faster epsilon goes to epsilon_minimum
+            # min is exp(-5) ~ 0.007 compare to exp(-1) ~ 0.37
+            epsilon = epsilon_minimum + math.exp(epsilon_decay_rate * steps_done) * epsilon_span
+
         bar = progressbar.ProgressBar(
             widgets=[
                 'Episode ',
@@ -573,54 +861,44 @@ def epsilon_greedy_search(
                 # progressbar.ETA(),
                 progressbar.Bar()
             ],
+            variables=dict(epsilon=epsilon, best_eval_mean=best_eval_running_mean),
+            min_poll_interval=PROGRESSBAR_MIN_POLL_INTERVAL,
             redirect_stdout=False)
 
-        if epsilon_exponential_decay:  # the less epsilon_exponential_decay, the faster epsilon goes to epsilon_minimum
-            epsilon = epsilon_minimum + math.exp(-5. * steps_done /  # min is exp(-5) ~ 0.007 compare to exp(-1) ~ 0.37
-                                                 (epsilon_exponential_decay * iteration_count)) * (initial_epsilon - epsilon_minimum)
+        # draw the explore/exploit uniforms for the whole episode at once, indexed by t
+        uniforms = rng.random(iteration_count + 1)
 
         for t in bar(range(1, 1 + iteration_count)):
 
             steps_done += 1
 
-            x = np.random.rand()
-            if x <= epsilon:
+            if uniforms[t] <= epsilon:
                 action_style, gym_action, action_metadata = learner.explore(wrapped_env)
                 logger.info("Choose exploration phase")
             else:
                 action_style, gym_action, action_metadata = learner.exploit(wrapped_env, observation)
                 if not gym_action:
                     logger.info("Enter exploration phase instead of exploitation")
-                    stats['exploit_deflected_to_explore'] += 1
+                    buffers.exploit_deflected_to_explore += 1
                     _, gym_action, action_metadata = learner.explore(wrapped_env)
 
             # Take the step
-            logger.debug(f"gym_action={gym_action}, action_metadata={action_metadata}") if configuration.log_results else None
+            if log_results:
+                logger.debug("gym_action=%s, action_metadata=%s", gym_action, action_metadata)
             observation, reward, done, info = wrapped_env.step(gym_action)
 
-            action_type = 'exploit' if action_style == 'exploit' else 'explore'
-            outcome = 'reward' if reward > 0 else 'noreward'
-            if 'local_vulnerability' in gym_action:
-                stats[action_type][outcome]['local'] += 1
-            elif 'remote_vulnerability' in gym_action:
-                stats[action_type][outcome]['remote'] += 1
-            else:
-                stats[action_type][outcome]['connect'] += 1
-
             learner.on_step(wrapped_env, observation, reward, done, info, action_metadata)
-            assert np.shape(reward) == ()
+            assert isinstance(reward, (int, float, np.number)), f"scalar reward expected, got {type(reward)}"
 
-            all_rewards.append(reward)
-            all_availability.append(info['network_availability'])
+            buffers.record(t, reward, info['network_availability'], action_style, gym_action)
             total_reward += reward
-            bar.update(t, reward=total_reward)
-            bar.update(t, epsilon=epsilon)
-            bar.update(t, best_eval_mean=best_eval_running_mean)
 
+            # set the variables directly so that they are only redrawn at the bar's polling rate
+            bar.variables['reward'] = total_reward
             if reward > 0:
-                bar.update(t, last_reward_at=t)
+                bar.variables['last_reward_at'] = t
 
-            if verbosity == Verbosity.Verbose or (verbosity == Verbosity.Normal and reward > 0):
+            if print_all_steps or (print_rewarded_steps and reward > 0):
                 sign = ['-', '+'][reward > 0]
 
                 print(f"    {sign} t={t} {action_style} r={reward} total_reward:{total_reward} "
@@ -639,9 +917,7 @@ def epsilon_greedy_search(
 
             if done:
                 episode_ended_at = t
-                bar.update(t, done_at=t)
-                bar.update(t, steps_done=steps_done)
-                bar.update(t, loss=getattr(learner, 'loss', None))
+                bar.update(t, done_at=t, steps_done=steps_done, loss=getattr(learner, 'loss', None))
                 bar.finish(dirty=True)
                 break
 
@@ -649,16 +925,13 @@ def epsilon_greedy_search(
         sys.stdout.flush()
         logger.info(str(bar._format_line()))
 
+        length = episode_ended_at if episode_ended_at else iteration_count
+        all_rewards = buffers.rewards[:length]
+
         loss_string = learner.loss_as_string()
 
-        if configuration.log_results:
-            for name, deception_tracker in observation['_deception_tracker'].items():
-                detection_points_results[name] = detection_points_results.get(name, [[], [0], []])
-                _, name_indptr, _ = detection_points_results[name]
-                # if len(deception_tracker.trigger_times):
-                detection_points_results[name][1] += [name_indptr[-1] + len(deception_tracker.trigger_times)]
-                detection_points_results[name][0] += deception_tracker.trigger_times
-                detection_points_results[name][2] += [episode_ended_at if episode_ended_at else iteration_count]
+        if log_results:
+            append_detection_points(detection_points_results, observation['_deception_tracker'], length)
 
         if loss_string:
             loss_string = f"loss={loss_string}"
@@ -668,7 +941,7 @@ def epsilon_greedy_search(
         else:
             print(f"Episode {i_episode} stopped at t={iteration_count} total_reward {total_reward} with {loss_string}")
 
-        print_stats(stats)
+        print_stats_counts(buffers.stats_counts, buffers.exploit_deflected_to_explore)
 
         # Evaluate model
         if not i_episode % eval_freq:
@@ -680,24 +953,27 @@ def epsilon_greedy_search(
                                                      verbosity=Verbosity.Quiet, save_model_filename=save_model_filename)
             best_eval_running_mean = trained_learner_results['best_running_mean']
 
-        all_episodes_sum_rewards.append(sum(all_rewards))
-        all_episodes_rewards.append(all_rewards)
-        all_episodes_availability.append(all_availability)
+        episode_reward = total_reward
+        if len(reward_window) == reward_window.maxlen:
+            reward_window_sum -= reward_window[0]
+        reward_window.append(episode_reward)
+        reward_window_sum += episode_reward
+        all_episodes_rewards.append(all_rewards.tolist())
+        all_episodes_availability.append(buffers.availability[:length].tolist())
 
-        mean_over_window = np.mean(all_episodes_sum_rewards[-mean_reward_window:])
+        mean_over_window = reward_window_sum / len(reward_window)
         if best_running_mean < mean_over_window:
             logger.info(f"New best running mean (eval): {mean_over_window}")
             best_running_mean = mean_over_window
 
             if save_model_filename:
-                learner.save(save_model_filename.replace('.tar', f'_steps{steps_done}.tar'))
-                learner.save(save_model_filename.replace('.tar', '_best.tar'))
+                save_checkpoint(learner, save_model_filename.replace('.tar', f'_steps{steps_done}.tar'),
+                                save_model_filename.replace('.tar', '_best.tar'))
 
-        if configuration.log_results and not only_eval_summary:
-            write_to_summary(writer, np.array(all_rewards), epsilon, loss_string, observation, iteration_count, best_running_mean,
-                             steps_done)
+        if log_results and not only_eval_summary:
+            write_to_summary(writer, episode_reward, buffers.rewarded_step_count, epsilon, loss_string, observation, iteration_count,
+                             best_running_mean, steps_done)
 
-        length = episode_ended_at if episode_ended_at else iteration_count
         learner.end_of_episode(i_episode=i_episode, t=length)
         if plot_episodes_length:
             plottraining.episode_done(length)
@@ -707,24 +983,40 @@ def epsilon_greedy_search(
         if epsilon_multdecay:
             epsilon = max(epsilon_minimum, epsilon * epsilon_multdecay)
 
-        if (not i_episode % (5 * eval_freq)) and configuration.log_results:
-            np.savez(os.path.join(configuration.log_dir, 'training', f'detection_points_results_e{i_episode}.npz'),
-                     **({name + '_indices': np.array(v[0]) for name, v in detection_points_results.items()} |
-                        {name + '_indptr': np.array(v[1]) for name, v in detection_points_results.items()} |
-                        {name + '_eplength': np.array(v[2]) for name, v in detection_points_results.items()}))
+        if (not i_episode % checkpoint_period) and log_results:
+            # periodic checkpoints only hold the episodes since the previous checkpoint,
+            # the complete results are written at the end of the training
+            new_triggers = sum(v.new_trigger_count for v in detection_points_results.values())
+            checkpoint_start = time.perf_counter()
+            max_time_fraction = configuration.checkpoint_max_time_fraction
+            if new_triggers >= configuration.checkpoint_min_new_triggers and \
+                    (max_time_fraction is None or last_checkpoint_duration <= max_time_fraction * (checkpoint_start - last_checkpoint_end)):
+                if pending_checkpoint is not None:
+                    pending_checkpoint.result()
+                # the checkpoint arrays are views of already written buffer entries, which appends never modify
+                checkpoint = detection_points_payload({name: v.take_checkpoint() for name, v in detection_points_results.items()})
+                pending_checkpoint = checkpoint_pool.submit(
+                    dump_detection_points, f'{training_dir}/detection_points_results_delta_e{i_episode}',
+                    checkpoint, configuration.detection_dump_format)
+                last_checkpoint_end = time.perf_counter()
+                last_checkpoint_duration = last_checkpoint_end - checkpoint_start
+            else:
+                logger.info(f"Skipping detection points checkpoint at episode {i_episode} ({new_triggers} new triggers)")
 
-    if configuration.log_results:
-        np.savez(os.path.join(configuration.log_dir, 'training', f'detection_points_results_e{i_episode}.npz'),
-                 **({name + '_indices': np.array(v[0]) for name, v in detection_points_results.items()} |
-                    {name + '_indptr': np.array(v[1]) for name, v in detection_points_results.items()} |
-                    {name + '_eplength': np.array(v[2]) for name, v in detection_points_results.items()}))
-        np.savez(os.path.join(configuration.log_dir, 'training', 'detection_points_results.npz'),
-                 **({name + '_indices': np.array(v[0]) for name, v in detection_points_results.items()} |
-                    {name + '_indptr': np.array(v[1]) for name, v in detection_points_results.items()} |
-                    {name + '_eplength': np.array(v[2]) for name, v in detection_points_results.items()}))
+    if pending_checkpoint is not None:
+        pending_checkpoint.result()
+    checkpoint_pool.shutdown()
+
+    if log_results:
+        save_detection_points(f'{training_dir}/detection_points_results_e{i_episode}.npz',
+                              detection_points_results)
+        link_file(f'{training_dir}/detection_points_results_e{i_episode}.npz',
+                  f'{training_dir}/detection_points_results.npz')
 
     wrapped_env.close()
-    logger.info("simulation ended\n") if configuration.log_results else None
+    if log_results:
+        writer.flush()
+        logger.info("simulation ended\n")
 
     if plot_episodes_length:
         plottraining.plot_end()
@@ -739,6 +1031,15 @@ def epsilon_greedy_search(
     )
 
 
+def _transfer_learning_worker(*args, **kwargs) -> TrainedLearner:
+    """Run `epsilon_greedy_search` in a worker process of `transfer_learning_evaluation`.
+    The worker only returns its results: it neither plots nor logs, so that it does not share
+    the tensorboard writer and the result files of the parent process"""
+    configuration.writer = None
+    configuration.log_results = False
+    return epsilon_greedy_search(*args, plot_episodes_length=False, **kwargs)
+
+
 def transfer_learning_evaluation(
     environment_properties: EnvironmentBounds,
     trained_learner: TrainedLearner,
@@ -747,13 +1048,16 @@ def transfer_learning_evaluation(
     eval_episode_count: int,
     iteration_count: int,
     benchmark_policy: Learner = RandomPolicy(),
-    benchmark_training_args=dict(title="Benchmark", epsilon=1.0)
+    benchmark_training_args=dict(title="Benchmark", epsilon=1.0),
+    parallel: bool = False
 ):
-    """Evaluated a trained agent on another environment of different size"""
+    """Evaluated a trained agent on another environment of different size
+
+    With `parallel` the trained agent and the benchmark run in two worker processes,
+    each on its own copy of `eval_env` and of its learner (the learners passed in are then left untouched),
+    without plotting the episode lengths or logging to tensorboard"""
 
-    eval_oneshot_all = epsilon_greedy_search(
-        eval_env,
-        environment_properties,
+    oneshot_args = dict(
         learner=trained_learner['learner'],
         episode_count=eval_episode_count,  # one shot from learnt Q matric
         iteration_count=iteration_count,
@@ -762,10 +1066,7 @@ def transfer_learning_evaluation(
         verbosity=Verbosity.Quiet,
         title=f"One shot on {eval_env.name} - Trained on {trained_learner['trained_on']}"
     )
-
-    eval_random = epsilon_greedy_search(
-        eval_env,
-        environment_properties,
+    benchmark_args = dict(
         learner=benchmark_policy,
         episode_count=eval_episode_count,
         iteration_count=iteration_count,
@@ -774,6 +1075,15 @@ def transfer_learning_evaluation(
         **benchmark_training_args
     )
 
+    if parallel:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            oneshot_future = executor.submit(_transfer_learning_worker, eval_env, environment_properties, **oneshot_args)
+            random_future = executor.submit(_transfer_learning_worker, eval_env, environment_properties, **benchmark_args)
+            eval_oneshot_all, eval_random = oneshot_future.result(), random_future.result()
+    else:
+        eval_oneshot_all = epsilon_greedy_search(eval_env, environment_properties, **oneshot_args)
+        eval_random = epsilon_greedy_search(eval_env, environment_properties, **benchmark_args)
+
     plot_averaged_cummulative_rewards(
         all_runs=[eval_oneshot_all, eval_random],
         title=f"Transfer learning {trained_learner['trained_on']}->{eval_env.name} "
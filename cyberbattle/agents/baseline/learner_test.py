@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Unit tests for the detection point results written by learner.py"""
+import numpy as np
+import pytest
+
+import cyberbattle.agents.baseline.learner as learner
+
+EPISODES = [
+    {'HT1': [3, 7], 'HT2': []},
+    {'HT1': [], 'HT2': [1]},
+    {'HT1': [2, 4, 5], 'HT2': [2, 6]},
+    {'HT1': [1], 'HT2': []},
+    {'HT1': [], 'HT2': []},
+]
+
+
+def append_episode(detection_points_results, triggers, episode_length: int = 10) -> None:
+    for name, trigger_times in triggers.items():
+        if name not in detection_points_results:
+            detection_points_results[name] = learner.DetectionPointsBuffer()
+        detection_points_results[name].append_episode(np.array(trigger_times, dtype=np.int64), episode_length)
+
+
+def assert_same_results(actual, expected) -> None:
+    assert actual.keys() == expected.keys()
+    for name in expected:
+        for actual_stream, expected_stream in zip(actual[name], expected[name]):
+            np.testing.assert_array_equal(actual_stream, expected_stream)
+
+
+def test_reassemble_detection_points_checkpoints(tmp_path) -> None:
+    """The periodic checkpoints only hold the episodes since the previous one,
+    and reassemble into the complete results saved at the end of the training"""
+    episodes = EPISODES * 2
+    detection_points_results = {}
+    # checkpoint file names sort as e10, e2, e9: they are reassembled in episode order
+    for i_episode, triggers in enumerate(episodes, start=1):
+        append_episode(detection_points_results, triggers, episode_length=10 + i_episode)
+        if i_episode in (2, 9, 10):
+            checkpoint = {name: v.take_checkpoint() for name, v in detection_points_results.items()}
+            assert all(indptr[0] == 0 for _, indptr, _ in checkpoint.values())
+            learner.dump_detection_points(str(tmp_path / f'detection_points_results_delta_e{i_episode}'),
+                                          learner.detection_points_payload(checkpoint))
+    checkpoint = {name: v.take_checkpoint() for name, v in detection_points_results.items()}
+    assert all(len(indices) == 0 and list(indptr) == [0] and len(eplength) == 0 for indices, indptr, eplength in checkpoint.values())
+
+    saved_path = str(tmp_path / f'detection_points_results_e{len(episodes)}.npz')
+    learner.save_detection_points(saved_path, detection_points_results)
+    saved = learner.load_detection_points(saved_path)
+
+    assert_same_results(learner.reassemble_detection_points(str(tmp_path)), saved)
+    np.testing.assert_array_equal(saved['HT1'][0], [3, 7, 2, 4, 5, 1] * 2)
+    np.testing.assert_array_equal(saved['HT1'][1], [0, 2, 2, 5, 6, 6, 8, 8, 11, 12, 12])
+    np.testing.assert_array_equal(saved['HT1'][2], np.arange(11, 21))
+
+
+def test_save_detection_points_round_trip(tmp_path) -> None:
+    """Each detection point is saved as `<name>_indices`, `<name>_indptr` and `<name>_eplength` arrays"""
+    detection_points_results = {}
+    for triggers in EPISODES:
+        append_episode(detection_points_results, triggers)
+
+    payload = learner.detection_points_payload({name: (v.indices, v.indptr, v.eplength)
+                                                for name, v in detection_points_results.items()})
+    assert sorted(payload) == sorted(name + suffix for name in ['HT1', 'HT2'] for suffix in learner.DETECTION_POINTS_SUFFIXES)
+
+    path = str(tmp_path / 'detection_points_results.npz')
+    learner.save_detection_points(path, detection_points_results)
+    with np.load(path) as data:
+        assert sorted(data.files) == sorted(payload)
+    assert_same_results(learner.load_detection_points(path),
+                        {name: (v.indices, v.indptr, v.eplength) for name, v in detection_points_results.items()})
+
+
+@pytest.mark.parametrize('dump_format', learner.DETECTION_DUMP_FORMATS)
+def test_dump_detection_points_formats(tmp_path, dump_format: str) -> None:
+    """Checkpoints written in each dump format load back unchanged, and reassemble alike"""
+    detection_points_results = {}
+    for triggers in EPISODES:
+        append_episode(detection_points_results, triggers)
+    checkpoint = {name: v.take_checkpoint() for name, v in detection_points_results.items()}
+
+    written = learner.dump_detection_points(str(tmp_path / 'detection_points_results_delta_e5'),
+                                            learner.detection_points_payload(checkpoint), dump_format)
+    assert written.endswith('.npz') == (dump_format != 'npy_dir')
+    assert_same_results(learner.load_detection_points(written), checkpoint)
+    assert_same_results(learner.reassemble_detection_points(str(tmp_path)), checkpoint)
+
+
+def test_dump_detection_points_unknown_format(tmp_path) -> None:
+    with pytest.raises(ValueError):
+        learner.dump_detection_points(str(tmp_path / 'detection_points_results_delta_e5'), {}, 'zarr')
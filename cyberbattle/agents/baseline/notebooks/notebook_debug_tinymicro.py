@@ -20,15 +20,27 @@
 
 """Notebook used for debugging purpose to train the
 the DQL agent and then run it one step at a time.
+
+With LOG_RESULTS set, the run writes to its log directory:
+    <run>_s<step>_chkpt<checkpoint>_network.csv   attacks of the network at each rendered step
+    <run>_chkpt<checkpoint>_network_steps.json   list of the plotly figures of the network at each rendered step,
+                                                  each entry can be read back with plotly.graph_objects.Figure
+    <run>_s<last step>_chkpt<checkpoint>_action.csv  actions taken and their rewards
+    <run>_chkpt<checkpoint>_network.png/.eps      image of the network after the last step
+Network snapshots are taken every RENDER_EVERY steps (every step by default, 0 disables them).
 """
 
 # pylint: disable=invalid-name
 
 # # %%
 import os
+import csv
+import json
 import logging
 import gym
 import datetime
+import torch
+from IPython import get_ipython
 from IPython.display import display
 from cyberbattle.agents.baseline.agent_wrapper import ActionTrackingStateAugmentation, AgentWrapper
 from cyberbattle.simulation.actions import Reward, Penalty
@@ -38,6 +50,7 @@ import cyberbattle.agents.baseline.agent_dql as dqla
 
 
 import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -63,6 +76,7 @@ eval_episode_count = int(os.getenv('EVAL_EPISODE_COUNT', 0))
 training_episode_count = None
 train_while_exploit = False
 reward_clip = os.getenv("REWARD_CLIP", 'False').lower() in ('true', '1', 't')
+render_every = int(os.getenv('RENDER_EVERY', 1))  # every step by default, 0 disables per-step network snapshots
 
 
 def main(gymid=gymid, training_episode_count=training_episode_count,
@@ -194,21 +208,36 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
                                         f'te{training_episode_count}_eval_steps{checkpoint_name}.tar'))
         dql_agent.train_while_exploit = False
         dql_agent.policy_net.eval()
+        # inference only from here on: freeze the scripted network so each exploit step runs a single optimized graph
+        dql_agent.policy_net = torch.jit.freeze(torch.jit.script(dql_agent.policy_net))
 
     if log_results:
         os.makedirs(log_dir, exist_ok=True)
 
     # # %%
+    action_columns = ["Step", "Reward", "Cumulative Reward", "Next action", "Processed by", "Precondition", "Profile", "Reward string"]
+    if log_results:
+        # rows are streamed as they come, the file is named after the last step once the loop is over
+        action_csv_partial = os.path.join(log_dir, f'{exploit_train}_{train_while_exploit*"ExploitUdpates"}_chkpt{checkpoint_name}_action.csv.partial')
+        action_csv_file = open(action_csv_partial, 'w', newline='')
+        action_csv = csv.writer(action_csv_file)
+        action_csv.writerow(action_columns)
+    network_frames = []
     h = []
     done = False
     total_reward = 0
     for i in range(max(iteration_count, len(manual_commands))):
-        wrapped_env.render(mode=['with_rewards', 'rgb_array'], filename=None if not log_results else
-                           os.path.join(log_dir, f'{exploit_train}_{train_while_exploit*"ExploitUdpates"}_s{i}_chkpt{checkpoint_name}_network.png'))
+        # the figure is only useful when written out, so skip building it otherwise; per-step figures are
+        # kept as plotly json and written together after the loop, the last network is rendered as an image below
+        if log_results and render_every and i % render_every == 0:
+            network_frames.append(wrapped_env.render_as_fig(
+                csv_filename=os.path.join(log_dir, f'{exploit_train}_{train_while_exploit*"ExploitUdpates"}_s{i}_chkpt{checkpoint_name}_network.csv'),
+                mode=['with_rewards']).to_dict())
         logger.info("")
         if done:
             break
-        # run the suggested action or exploited action
+        # run the suggested action or exploited action; manual commands are translated step by step since
+        # the external indices they map to (discovered nodes, profiles, cached credentials) only exist once discovered
         action_style, next_action, _ = dql_agent.exploit(wrapped_env, current_o) if checkpoint_name != 'manual' else  \
             wrapped_env.pretty_print_to_internal_action(manual_commands[i])
 
@@ -218,19 +247,28 @@ def main(gymid=gymid, training_episode_count=training_episode_count,
         current_o, reward, done, info = wrapped_env.step(next_action)
         total_reward += reward
         action_str, reward_str = wrapped_env.internal_action_to_pretty_print(next_action, output_reward_str=True)
-        h.append((i,  # wrapped_env.get_explored_network_node_properties_bitmap_as_numpy(current_o),
-                  reward, total_reward,
-                  action_str, action_style, info['precondition_str'], info['profile_str'], info["reward_string"]))
+        row = (i,  # wrapped_env.get_explored_network_node_properties_bitmap_as_numpy(current_o),
+               reward, total_reward,
+               action_str, action_style, info['precondition_str'], info['profile_str'], info["reward_string"])
+        h.append(row)
+        if log_results:
+            action_csv.writerow(row)
 
-    df = pd.DataFrame(h, columns=["Step", "Reward", "Cumulative Reward", "Next action", "Processed by", "Precondition", "Profile", "Reward string"])
-    df.set_index("Step", inplace=True)
-    pd.set_option("max_colwidth", 80)
-    if log_results:
-        display(df)
+    if network_frames:
+        with open(os.path.join(log_dir, f'{exploit_train}_{train_while_exploit*"ExploitUdpates"}_chkpt{checkpoint_name}_network_steps.json'), 'w') as frames_file:
+            json.dump(network_frames, frames_file, cls=PlotlyJSONEncoder)
 
     if log_results:
-        df.to_csv(os.path.join(log_dir, f'{exploit_train}_{train_while_exploit*"ExploitUdpates"}_s{i}_chkpt{checkpoint_name}_action.csv'))  # ,
-        # index=False)
+        action_csv_file.close()
+        os.replace(action_csv_partial,
+                   os.path.join(log_dir, f'{exploit_train}_{train_while_exploit*"ExploitUdpates"}_s{i}_chkpt{checkpoint_name}_action.csv'))
+
+        # the table is only worth building when there is a notebook frontend to show it
+        if get_ipython() is not None:
+            df = pd.DataFrame(h, columns=action_columns)
+            df.set_index("Step", inplace=True)
+            pd.set_option("max_colwidth", 80)
+            display(df)
     print(f'len: {len(h)}, cumulative reward: {total_reward}')
 
     # # %%
@@ -13,10 +13,12 @@ import dataclasses
 from datetime import time, datetime
 from boolean import boolean
 from collections import OrderedDict
+import functools
+import itertools
+import logging
 import sys
-import re
 from enum import Enum
-from typing import Iterator, List, Optional, Set, Tuple, Dict, TypedDict, cast
+from typing import Iterable, Iterator, List, Optional, Set, FrozenSet, Tuple, Dict, TypedDict
 from IPython.display import display
 import pandas as pd
 import numpy as np
@@ -110,6 +112,31 @@ class ErrorType(Enum):
     NO_AUTH = 6
 
 
+# Log message of an executed action, formatted with: reward, vulnerability ID, node ID, profile, precondition, reward string
+_LOGGER_ACTION_FMT = "GOT REWARD r={0} with \tAction: {2}/{1}\tProfile: {3},\tPrecondition: {4}\t Description: {5}"
+# Log message of a failed action by error type, with the needed roles as additional format argument {6}
+_ERROR_STRINGS: Dict[ErrorType, str] = {
+    error_type: error_string + " => " + _LOGGER_ACTION_FMT
+    for error_type, error_string in {
+        ErrorType.REPEATED: "Repeated action",
+        ErrorType.IP_LOCAL_NEEDED: "No access use VPN",
+        ErrorType.ROLES_WRONG: "Error {6} only",
+        # THIS should be invalid actually, for example, if DOCUMENT is not discovered
+        ErrorType.PROPERTY_WRONG: "Not discovered property",
+        ErrorType.WRONG_AUTH: "Wrong Authentification",
+        ErrorType.NO_AUTH: "Authentification required",
+        ErrorType.OTHER: "Cannot get {2}/{1}",
+    }.items()}
+
+
+def with_slots(cls):
+    """Rebuild a dataclass with `__slots__` for its fields (`dataclass(slots=True)` requires Python 3.10)"""
+    field_names = tuple(field.name for field in dataclasses.fields(cls))
+    cls_dict = {k: v for k, v in cls.__dict__.items() if k not in field_names + ('__dict__', '__weakref__')}
+    cls_dict['__slots__'] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
 class EdgeAnnotation(Enum):
     """Annotation added to the network edges created as the simulation is played"""
     KNOWS = 0
@@ -117,6 +144,7 @@ class EdgeAnnotation(Enum):
     LATERAL_MOVE = 2
 
 
+@with_slots
 @dataclass
 class ActionResult:
     """Result from executing an action"""
@@ -130,12 +158,47 @@ class ActionResult:
 ALGEBRA = boolean.BooleanAlgebra()
 
 
+@functools.lru_cache(maxsize=None)
+def profile_symbols(profile_str: str) -> FrozenSet[boolean.Symbol]:
+    """Symbols of a profile given as its string form (see `model.Profile.__str__`)"""
+    return frozenset(ALGEBRA.parse(profile_str).get_symbols())
+
+
+def discovery_reward(nodes: int, credentials: int, profiles: int, properties: int) -> float:
+    """Reward for the newly discovered entities of an attack outcome"""
+    return nodes * Reward.NODE_DISCOVERED_REWARD + credentials * Reward.CREDENTIAL_DISCOVERED_REWARD + \
+        profiles * Reward.PROFILE_DISCOVERED_REWARD + properties * Reward.PROPERTY_DISCOVERED_REWARD
+
+
+def keep_best_candidate(candidate_reward: float, max_reward: float, tie_count: int) -> Tuple[bool, int]:
+    """Reservoir sampling of a uniformly random candidate among the ones with the maximum reward.
+    Return whether to keep the candidate, and the updated number of candidates tied at the maximum reward."""
+    if candidate_reward > max_reward:
+        return True, 1
+    if candidate_reward == max_reward:
+        return np.random.random() * (tie_count + 1) < 1.0, tie_count + 1
+    return False, tie_count
+
+
+# Outcome classes dispatched on by the entity discovery and by the reward evaluation of an attack
+DISCOVERY_OUTCOMES = (model.LeakedCredentials, model.LeakedNodesId, model.LeakedProfiles)
+REWARD_OUTCOMES = (model.PrivilegeEscalation, model.LateralMove, model.CustomerData, model.DetectionPoint)
+
+
+@functools.lru_cache(maxsize=None)
+def outcome_kind(outcome_type: type, kinds: Tuple[type, ...]) -> Optional[type]:
+    """The first class in `kinds` that `outcome_type` derives from, or None.
+    Outcomes combined by `model.concatenate_outcomes` resolve as a chain of isinstance checks in that order would."""
+    return next((kind for kind in kinds if issubclass(outcome_type, kind)), None)
+
+
+@with_slots
 @dataclass
 class NodeTrackingInformation:
     """Track information about nodes gathered throughout the simulation"""
-    # Map (vulnid, local_or_remote) to time of last attack.
+    # Map (vulnid, local_or_remote, precondition uid, succeeded) to time of last attack.
     # local_or_remote is true for local, false for remote
-    last_attack: Dict[Tuple[model.VulnerabilityID, bool, model.Precondition, bool], time] = dataclasses.field(default_factory=dict)
+    last_attack: Dict[Tuple[model.VulnerabilityID, bool, int, bool], time] = dataclasses.field(default_factory=dict)
     # Last time the node got owned by the attacker agent
     last_owned_at: Optional[time] = None
     # All node properties discovered so far (indexes of _environment.identifiers.properties without privilege_tags)
@@ -158,64 +221,87 @@ class AgentActions:
         """
         self._environment = environment
         self._gathered_credentials: Set[model.CredentialID] = set()
-        self._gathered_profiles: List[model.Profile] = [model.Profile(username="NoAuth")]
-        self._discovered_nodes: OrderedDict[model.NodeID, NodeTrackingInformation] = OrderedDict()
+        self._gathered_profiles: OrderedDict[str, model.Profile] = OrderedDict(NoAuth=model.Profile(username="NoAuth"))  # by username
+        self._discovered_nodes: Dict[model.NodeID, NodeTrackingInformation] = {}
         self._throws_on_invalid_actions = throws_on_invalid_actions
         self.deception_penalty_raise = False
+        # results of _evaluate_precondition by (target, count of its discovered properties, precondition uid, profile symbols)
+        self._precondition_cache: Dict[Tuple[model.NodeID, int, int, FrozenSet[boolean.Symbol]], ErrorType] = {}
+        # property symbols of each precondition with their property index, by precondition uid
+        self._property_symbol_indices: Dict[int, List[Tuple[boolean.Symbol, Optional[int]]]] = {}
 
         # List of all special tags indicating a privilege level reached on a node
         self.privilege_tags = [model.PrivilegeEscalation(p).tag for p in list(PrivilegeLevel)]
+        self._privilege_tags_set = set(self.privilege_tags)
+        # index of each property in environment.identifiers.properties
+        self._property_index: Dict[PropertyName, int] = {p: i for i, p in enumerate(environment.identifiers.properties)}
+        self._global_properties = frozenset(environment.identifiers.global_properties)
+        self._initial_properties = frozenset(environment.identifiers.initial_properties)
+        self._global_property_indices = frozenset(self._property_index[p] for p in self._global_properties)
+        # indices of the global properties discovered so far, shared by every discovered node
+        self._current_global_properties: Set[int] = set()
+        # names of the global vulnerabilities, by type filter of list_vulnerabilities_in_target (None for all types)
+        self._global_vulnerabilities_by_type: Dict[Optional[VulnerabilityType], Set[str]] = {
+            type_filter: set().union(*(model.vuln_name_from_vuln(None, vuln_id, vulnerability)
+                                       for vuln_id, vulnerability in environment.vulnerability_library.items()
+                                       if type_filter is None or vulnerability.type == type_filter))
+            for type_filter in [None, *VulnerabilityType]}
+        # nodes by the privilege level they were last owned at, in environment order;
+        # re-imaging by the defender lowers the level of a node without updating this index
+        self._node_order: Dict[model.NodeID, int] = {}
+        self._nodes_by_privilege: Dict[PrivilegeLevel, Set[model.NodeID]] = {level: set() for level in PrivilegeLevel}
+        for i, (node_id, node) in enumerate(environment.nodes()):
+            self._node_order[node_id] = i
+            self._nodes_by_privilege[node.privilege_level].add(node_id)
         self.__ip_local = False
 
         # Mark all owned nodes as discovered
         # Mark all initial_properties among node & global proerties as discovered_properties for this node
+        intersect_with_global_properties = self._global_properties & self._initial_properties
+        self._current_global_properties.update(self._property_index[p] for p in intersect_with_global_properties)
         for i, node in environment.nodes():
             if node.agent_installed:
                 self.__mark_node_as_owned(i, PrivilegeLevel.LocalUser)
-                intersect_with_global_properties = list(set(self._environment.identifiers.global_properties).intersection(self._environment.identifiers.initial_properties))
-                self.__mark_nodeproperties_as_discovered(i, intersect_with_global_properties)
+                self.__mark_nodeproperties_as_discovered(i, list(intersect_with_global_properties))
 
     def discovered_nodes(self) -> Iterator[Tuple[model.NodeID, model.NodeInfo]]:
         for node_id in self._discovered_nodes:
             yield (node_id, self._environment.get_node(node_id))
 
-    def _check_profile(self, profile: model.Profile, precondition: model.Precondition) -> Tuple[bool, bool, bool]:
-        """ This is a quick helper function toc check profile macthcing with precondition, disregarding of properties in precondition
+    def _evaluate_precondition(self, target: model.NodeID, profile: model.Profile, current_profile_symbols: FrozenSet[boolean.Symbol],
+                               precondition: model.Precondition, ip_local_flag: bool) -> ErrorType:
+        """ Check a precondition against the profile, then against the discovered properties of the target node.
+            Return the first requirement which is not met, or ErrorType.NOERROR if the precondition holds.
             TODO: change logic of matching, try omit username/id/roles, rather than having True by default,
             because of ~(NOT) in experssion"""
-        expr = precondition.expression
-        profile_symbols = ALGEBRA.parse(str(profile)).get_symbols()
-
-        true_value = ALGEBRA.parse('true')
-        false_value = ALGEBRA.parse('false')
-        mapping = {exp_symbol: true_value if not model.Profile.is_profile_symbol(str(exp_symbol)) or exp_symbol in profile_symbols else false_value
-                   for exp_symbol in expr.get_symbols()}
-        wo_roles_mapping = {exp_symbol: true_value if not model.Profile.is_profile_symbol(str(exp_symbol)) or model.Profile.is_role_symbol(str(exp_symbol)) or exp_symbol in profile_symbols else false_value
-                            for exp_symbol in expr.get_symbols()}
-
-        is_true: bool = cast(boolean.Expression, expr.subs(mapping)).simplify() == true_value
-        wo_roles_is_true: bool = cast(boolean.Expression, expr.subs(wo_roles_mapping)).simplify() == true_value
-        # wo_username_true: bool = False if not is_true and wo_roles_is_true else True
-        only_roles_true: bool = np.sum(map(mapping.get, filter(re.compile("roles").match, mapping.keys())))
-        return is_true, wo_roles_is_true, only_roles_true
-
-    def _check_properties_after_profile_check(self, target: model.NodeID, profile: model.Profile, precondition: model.Precondition) -> bool:
-        """
-        This is a quick helper function to check the properties to see if
-        they match the ones supplied.
-        """
-        # node: model.NodeInfo = self._environment.network.nodes[target]['data']
-        node_properties = {self._environment.identifiers.properties[p] for p in self.get_discovered_properties(target)}  # only discovered properties, not all ## node.properties
-
-        expr = precondition.expression
-        profile_symbols = ALGEBRA.parse(str(profile)).get_symbols()
-
-        true_value = ALGEBRA.parse('true')
-        false_value = ALGEBRA.parse('false')
-        mapping = {exp_symbol: true_value if str(exp_symbol) in node_properties or model.Profile.is_profile_symbol(str(exp_symbol)) and exp_symbol in profile_symbols else false_value
-                   for exp_symbol in expr.get_symbols()}
-        is_true: bool = cast(boolean.Expression, expr.subs(mapping)).simplify() == true_value
-        return is_true
+        if precondition.needs_ip_local and not ip_local_flag:
+            return ErrorType.IP_LOCAL_NEEDED
+
+        # discovered properties of a node only grow, their count identifies them
+        node_tracking = self._discovered_nodes.get(target)
+        discovered_properties = node_tracking.discovered_properties if node_tracking else set()
+        cache_key = (target, len(discovered_properties), precondition.uid, current_profile_symbols)
+        if cache_key in self._precondition_cache:
+            return self._precondition_cache[cache_key]
+
+        # profile check, disregarding of properties in precondition
+        if not precondition.evaluate(precondition.property_symbols | current_profile_symbols):
+            wo_roles_is_true: bool = precondition.evaluate(precondition.property_symbols | current_profile_symbols | precondition.role_symbols)
+            error_type = ErrorType.ROLES_WRONG if wo_roles_is_true else (ErrorType.NO_AUTH if profile.username == "NoAuth" else ErrorType.WRONG_AUTH)
+        else:
+            # only discovered properties, not all ## node.properties
+            true_symbols = {symbol for symbol, index in self.__property_symbol_indices(precondition) if index in discovered_properties}
+            error_type = ErrorType.NOERROR if precondition.specialize(current_profile_symbols)(true_symbols) else ErrorType.PROPERTY_WRONG
+        self._precondition_cache[cache_key] = error_type
+        return error_type
+
+    def __property_symbol_indices(self, precondition: model.Precondition) -> List[Tuple[boolean.Symbol, Optional[int]]]:
+        """Property symbols of the precondition paired with their index in environment.identifiers.properties"""
+        symbol_indices = self._property_symbol_indices.get(precondition.uid)
+        if symbol_indices is None:
+            symbol_indices = self._property_symbol_indices[precondition.uid] = \
+                [(symbol, self._property_index.get(str(symbol))) for symbol in precondition.property_symbols]
+        return symbol_indices
 
     def list_vulnerabilities_in_target(
             self,
@@ -232,19 +318,14 @@ class AgentActions:
 
         target_node_data: model.NodeInfo = self._environment.get_node(target)
 
-        global_vuln: Set[model.VulnerabilityID] = set.union(*([
-            model.vuln_name_from_vuln(None, vuln_id, vulnerability)
-            for vuln_id, vulnerability in self._environment.vulnerability_library.items()
-            if (type_filter is None or vulnerability.type == type_filter)] + [set()])
-        )
+        vulnerabilities: Set[model.VulnerabilityID] = set(self._global_vulnerabilities_by_type[type_filter])
 
-        local_vuln = set.union(*([
-            model.vuln_name_from_vuln(None, vuln_id, vulnerability)
-            for vuln_id, vulnerability in target_node_data.vulnerabilities.items()
-            if (type_filter is None or vulnerability.type == type_filter)] + [set()])
-        )
+        # node vulnerabilities can be changed by the defender, they are not cached
+        for vuln_id, vulnerability in target_node_data.vulnerabilities.items():
+            if type_filter is None or vulnerability.type == type_filter:
+                vulnerabilities.update(model.vuln_name_from_vuln(None, vuln_id, vulnerability))
 
-        return list(global_vuln.union(local_vuln))
+        return list(vulnerabilities)
 
     def __annotate_edge(self, source_node_id: model.NodeID,
                         target_node_id: model.NodeID,
@@ -266,38 +347,49 @@ class AgentActions:
         newly_discovered = node_id not in self._discovered_nodes
         newly_discovered_properties = 0
 
-        only_global_properties = set(list(self._discovered_nodes.items())[0][1].discovered_properties).intersection(self._environment.identifiers.global_properties)  # self._discovered_nodes and
         node_info = self._environment.get_node(node_id)
-        only_initial_properties = set(node_info.properties).intersection(self._environment.identifiers.initial_properties)
+        only_initial_properties = self._initial_properties.intersection(node_info.properties)
         if propagate and newly_discovered:
             logger.info('discovered node: ' + node_id)
-            self._discovered_nodes[node_id] = NodeTrackingInformation()
-        newly_discovered_properties = self.__mark_nodeproperties_as_discovered(node_id, only_global_properties.union(only_initial_properties), propagate=propagate)
+            # a newly discovered node starts with all global properties discovered so far
+            self._discovered_nodes[node_id] = NodeTrackingInformation(discovered_properties=set(self._current_global_properties))
+        newly_discovered_properties = self.__mark_nodeproperties_as_discovered(node_id, only_initial_properties, propagate=propagate)
         return newly_discovered_properties
 
+    def __mark_global_properties_as_discovered(self, properties: Iterable[PropertyName]) -> None:
+        """Add the global properties not discovered yet among `properties` to every discovered node"""
+        new_global_properties = self._global_property_indices.intersection(
+            self._property_index[p] for p in properties) - self._current_global_properties
+        if not new_global_properties:
+            return
+        self._current_global_properties |= new_global_properties
+        for node_tracking in self._discovered_nodes.values():
+            node_tracking.discovered_properties |= new_global_properties
+
     def __mark_nodeproperties_as_discovered(self, node_id: model.NodeID, properties: List[PropertyName], propagate: bool = True) -> int:
 
         # node_info = self._environment.get_node(node_id)
 
-        properties_indices = [self._environment.identifiers.properties.index(p)
+        properties_indices = [self._property_index[p]
                               for p in properties
-                              if p not in self.privilege_tags]  # and p in node_info.properties
+                              if p not in self._privilege_tags_set]  # and p in node_info.properties
 
-        if node_id in self._discovered_nodes:
+        node_tracking = self._discovered_nodes.get(node_id)
+        if node_tracking is not None:
+            discovered_properties = node_tracking.discovered_properties
             if not propagate:
-                return len(set(properties_indices) - self._discovered_nodes[node_id].discovered_properties)
+                return len(set(properties_indices) - discovered_properties)
 
-            before_count = len(self._discovered_nodes[node_id].discovered_properties)
-            self._discovered_nodes[node_id].discovered_properties = self._discovered_nodes[node_id].discovered_properties.union(properties_indices)
-        else:
-            if not propagate:
-                return len(properties_indices)
+            # each node owns its set of discovered properties, it is grown in place
+            before_count = len(discovered_properties)
+            discovered_properties.update(properties_indices)
+            return len(discovered_properties) - before_count
 
-            before_count = 0
-            self._discovered_nodes[node_id] = NodeTrackingInformation(discovered_properties=set(properties_indices))
+        if not propagate:
+            return len(properties_indices)
 
-        newly_discovered_properties = len(self._discovered_nodes[node_id].discovered_properties) - before_count
-        return newly_discovered_properties
+        node_tracking = self._discovered_nodes[node_id] = NodeTrackingInformation(discovered_properties=set(properties_indices))
+        return len(node_tracking.discovered_properties)
 
     def __mark_allnodeproperties_as_discovered(self, node_id: model.NodeID, propagate: bool = True):
         node_info: model.NodeInfo = self._environment.network.nodes[node_id]['data']
@@ -318,6 +410,9 @@ class AgentActions:
                 self._discovered_nodes[node_id] = NodeTrackingInformation()
             node_info.agent_installed = True
             node_info.privilege_level = model.escalate(node_info.privilege_level, privilege)
+            for nodes in self._nodes_by_privilege.values():
+                nodes.discard(node_id)
+            self._nodes_by_privilege[node_info.privilege_level].add(node_id)
             self._environment.network.nodes[node_id].update({'data': node_info})
 
             self.__mark_allnodeproperties_as_discovered(node_id, propagate)
@@ -330,7 +425,9 @@ class AgentActions:
     def __mark_discovered_entities(self, reference_node: model.NodeID, outcome: model.VulnerabilityOutcome,
                                    propagate: bool = True) -> Tuple[int, int, int, int, int, bool]:
         """Mark discovered entities as such and return
-        the number of newly discovered nodes, their total value and the number of newly discovered credentials"""
+        the number of newly discovered nodes, their total value and the number of newly discovered credentials.
+        With `propagate=False` nothing is marked, only the counts are returned: this previews an outcome
+        while scoring preconditions, the winning outcome is then committed once with `propagate=True`"""
         newly_discovered_nodes = 0
         newly_discovered_nodes_value = 0
         newly_discovered_credentials = 0
@@ -338,9 +435,10 @@ class AgentActions:
         newly_discovered_properties = 0
         ip_local_change = False
 
-        if isinstance(outcome, model.LeakedCredentials):
+        kind = outcome_kind(type(outcome), DISCOVERY_OUTCOMES)
+        if kind is model.LeakedCredentials:
             for credential in outcome.credentials:
-                new_properties = self.__mark_node_as_discovered(credential.node)
+                new_properties = self.__mark_node_as_discovered(credential.node, propagate=propagate)
                 if new_properties:
                     newly_discovered_nodes += 1
                     newly_discovered_nodes_value += self._environment.get_node(credential.node).value
@@ -355,7 +453,7 @@ class AgentActions:
                     logger.info('discovered credential: ' + str(credential))
                     self.__annotate_edge(reference_node, credential.node, EdgeAnnotation.KNOWS)
 
-        elif isinstance(outcome, model.LeakedNodesId):
+        elif kind is model.LeakedNodesId:
             for node_id in outcome.discovered_nodes:
                 new_properties = self.__mark_node_as_discovered(node_id, propagate=propagate)
                 if new_properties:
@@ -366,7 +464,7 @@ class AgentActions:
                 if propagate:
                     self.__annotate_edge(reference_node, node_id, EdgeAnnotation.KNOWS)
 
-        elif isinstance(outcome, model.LeakedProfiles):
+        elif kind is model.LeakedProfiles:
             for profile_str in outcome.discovered_profiles:
 
                 profile_dict = model.profile_str_to_dict(profile_str)
@@ -377,22 +475,21 @@ class AgentActions:
                     # # profile.update(profile_dict)
                     # newly_discovered_profiles += len(profile_dict)
                 else:
-                    if profile_dict["username"] not in [prof.username for prof in self._gathered_profiles]:
+                    if profile_dict["username"] not in self._gathered_profiles:
                         newly_discovered_profiles += len(profile_dict)
                         if propagate:
-                            self._gathered_profiles.append(model.Profile(**profile_dict))
+                            self._gathered_profiles[profile_dict["username"]] = model.Profile(**profile_dict)
                             if len(profile_dict) > 0:
-                                logger.info(f'discovered profile: {profile_str} with N={len(profile_dict)} newly discovered properties ')
+                                logger.info('discovered profile: %s with N=%d newly discovered properties ', profile_str, len(profile_dict))
                     else:
-                        for profile in self._gathered_profiles:
-                            if profile_dict["username"] == profile.username:
-                                n_updates = profile.update(profile_dict, propagate=propagate)
-                                newly_discovered_profiles += n_updates
-                                if propagate and n_updates > 0:
-                                    logger.info(f'discovered profile: {profile_str} with N={n_updates} newly discovered properties to profile {profile.username}')
-                                # for key, value in dataclasses.asdict(profile):
-                                #     if value is None and key in profile_dict.keys():
-                                #         profile
+                        profile = self._gathered_profiles[profile_dict["username"]]
+                        n_updates = profile.update(profile_dict, propagate=propagate)
+                        newly_discovered_profiles += n_updates
+                        if propagate and n_updates > 0:
+                            logger.info('discovered profile: %s with N=%d newly discovered properties to profile %s', profile_str, n_updates, profile.username)
+                        # for key, value in dataclasses.asdict(profile):
+                        #     if value is None and key in profile_dict.keys():
+                        #         profile
 
                 if not (self.__ip_local or ip_local_change):
                     ip_local_change = "ip.local" in profile_str
@@ -407,7 +504,8 @@ class AgentActions:
 
     def get_nodes_with_atleast_privilegelevel(self, level: PrivilegeLevel) -> List[model.NodeID]:
         """Return all nodes with at least the specified privilege level"""
-        return [n for n, info in self._environment.nodes() if info.privilege_level >= level]
+        candidates = itertools.chain.from_iterable(nodes for bucket_level, nodes in self._nodes_by_privilege.items() if bucket_level >= level)
+        return sorted((n for n in candidates if self._environment.get_node(n).privilege_level >= level), key=self._node_order.__getitem__)
 
     def is_node_discovered(self, node_id: model.NodeID) -> bool:
         """Returns true if previous actions have revealed the specified node ID"""
@@ -445,7 +543,7 @@ class AgentActions:
                 # THIS should never occure.
                 # It was only possible with target_node being random,
                 # now everything is in action_mask, and isinvalid(...) check is done to change exploit -> explore
-                logger.warning("Vulnerability '{}' not supported by node '{}'".format(vulnerability_id, node_id))
+                logger.warning("Vulnerability '%s' not supported by node '%s'", vulnerability_id, node_id)
                 return False, ActionResult(reward=Penalty.SUPSPICIOUSNESS, outcome=None, profile=str(profile), precondition="", reward_string="SUSPICIOUSNESS action")
 
         vulnerability = vulnerabilities[vulnerability_id]
@@ -459,23 +557,17 @@ class AgentActions:
         max_reward, max_outcome, max_precondition_index = -sys.float_info.max, None, -1
 
         error_type = ErrorType.OTHER
-        logger_action = "GOT REWARD r={0} with \tAction: {2}/{1}\tProfile: {3},\tPrecondition: {4}\t Description: {5}"
-        error_string_dict = {
-            ErrorType.REPEATED: "Repeated action",
-            ErrorType.IP_LOCAL_NEEDED: "No access use VPN",
-            ErrorType.ROLES_WRONG: "Error {6} only",
-            # THIS should be invalid actually, for example, if DOCUMENT is not discovered
-            ErrorType.PROPERTY_WRONG: "Not discovered property",
-            ErrorType.WRONG_AUTH: "Wrong Authentification",
-            ErrorType.NO_AUTH: "Authentification required",
-            ErrorType.OTHER: "Cannot get {2}/{1}",
-        }
 
         ip_local_flag = profile.ip == "local" if profile else False  # means we choose to try local network vuln using SSRF
-        max_reward_list = []
-        max_outcome_list = []
-        max_precondition_index_list = []
-        error_type_list = []
+        current_profile_symbols = profile.symbols if profile else profile_symbols(str(profile))
+        # reward constants looked up once, they are read for every precondition below
+        repeat_penalty, deception_penalty = Penalty.REPEAT, Penalty.DECEPTION_PENALTY_FOR_AGENT
+        failed_exploit_penalty, no_vpn_penalty = Penalty.FAILED_REMOTE_EXPLOIT, Penalty.NO_VPN
+        new_attack_reward, ip_local_reward, ssrf_reward = Reward.NEW_SUCCESSFULL_ATTACK_REWARD, Reward.IP_CHANGE_TO_IP_LOCAL, Reward.SSRF
+        # the scoring loop below only previews outcomes, it does not start tracking new nodes
+        node_tracking = self._discovered_nodes.get(node_id)
+        node_last_attack = node_tracking.last_attack if node_tracking else {}
+        tie_count = 0  # number of preconditions reaching max_reward so far
         need_chemist, need_doctor = False, False
 
         precond_ind_outcome_str_iter = iter(zip(precondition, range(len(precondition)), outcome)) \
@@ -484,74 +576,68 @@ class AgentActions:
         for precondition, precondition_index, outcome in precond_ind_outcome_str_iter:
             reward = -vulnerability.cost
 
-            if "ip.local" in [str(i) for i in precondition.expression.get_symbols() if '.' in str(i)] and \
-                    not ip_local_flag:
-                if max_reward <= reward + Penalty.NO_VPN:
-                    error_type_list.append(ErrorType.IP_LOCAL_NEEDED)
-                    max_precondition_index_list.append(precondition_index)
-                    max_reward_list.append(reward + Penalty.NO_VPN)
-                    max_outcome_list.append(model.ExploitFailed())
-                continue
-
-            is_true, wo_roles_is_true, only_roles_true = self._check_profile(profile, precondition)
-            if not is_true:
-                if max_reward <= reward + Penalty.FAILED_REMOTE_EXPLOIT:
-                    error_type_list.append(ErrorType.ROLES_WRONG if wo_roles_is_true else
-                                           (ErrorType.NO_AUTH if profile.username == "NoAuth" else ErrorType.WRONG_AUTH))
-                    need_doctor, need_chemist = precondition.need_roles()
-                    max_precondition_index_list.append(precondition_index)
-                    max_reward_list.append(reward + Penalty.FAILED_REMOTE_EXPLOIT)
-                    max_outcome_list.append(model.ExploitFailed())
-                continue
-
             # check vulnerability prerequisites
-            if not self._check_properties_after_profile_check(node_id, profile, precondition):
-                if max_reward <= reward + failed_penalty:
-                    error_type_list.append(ErrorType.PROPERTY_WRONG)
-                    max_precondition_index_list.append(precondition_index)
-                    max_reward_list.append(reward + failed_penalty)
-                    max_outcome_list.append(model.ExploitFailed())
+            precondition_error = self._evaluate_precondition(node_id, profile, current_profile_symbols, precondition, ip_local_flag)
+            if precondition_error != ErrorType.NOERROR:
+                penalty = no_vpn_penalty if precondition_error == ErrorType.IP_LOCAL_NEEDED else \
+                    (failed_penalty if precondition_error == ErrorType.PROPERTY_WRONG else failed_exploit_penalty)
+                keep, tie_count = keep_best_candidate(reward + penalty, max_reward, tie_count)
+                if keep:
+                    if precondition_error in (ErrorType.ROLES_WRONG, ErrorType.NO_AUTH, ErrorType.WRONG_AUTH):
+                        need_doctor, need_chemist = precondition.need_roles()
+                    max_reward, max_outcome, error_type, max_precondition_index = \
+                        reward + penalty, model.ExploitFailed(), precondition_error, precondition_index
                 continue
 
             # Check first if one of outcomes is ExploitFailed
             # ExploitFailed used for 2 cases 1) error (above) 2) deception trigger (here)
             if isinstance(outcome, model.ExploitFailed):
                 # reward = -vulnerability.cost
-                reward += -outcome.cost if outcome.cost is not None else Penalty.FAILED_REMOTE_EXPLOIT
+                reward += -outcome.cost if outcome.cost is not None else failed_exploit_penalty
                 # Here process deception reward if we want
                 # But we include already possible penalty in outcome == model.DetectionPoint
                 # reward += self.deception_penalty_raise * Penalty.DECEPTION_PENALTY_FOR_AGENT * outcome.deception
-                if max_reward <= reward:
-                    error_type_list.append(ErrorType.OTHER)
-                    max_precondition_index_list.append(precondition_index)
-                    max_reward_list.append(reward)
-                    max_outcome_list.append(outcome)
+                keep, tie_count = keep_best_candidate(reward, max_reward, tie_count)
+                if keep:
+                    max_reward, max_outcome, error_type, max_precondition_index = reward, outcome, ErrorType.OTHER, precondition_index
+                continue
+
+            # A repeated attack gets the REPEAT penalty whatever its outcome, check it before evaluating the outcome
+            # TOCHECK should be never true, as once we discover node_id, we should input it,
+            # if target_node_id is not inside desicovered_nodes yet,
+            # 1) action_mask, shoudl have excluded it 2) exploit_remote_vulnerability excludes it
+            last_attack_time = node_last_attack.get((vulnerability_id, local_or_remote, precondition.uid, True))
+
+            if last_attack_time is not None and (node_info.last_reimaging is None or last_attack_time >= node_info.last_reimaging):
+                keep, tie_count = keep_best_candidate(repeat_penalty - vulnerability.cost, max_reward, tie_count)
+                if keep:
+                    max_reward, max_outcome, error_type, max_precondition_index = \
+                        repeat_penalty - vulnerability.cost, outcome, ErrorType.REPEATED, precondition_index
                 continue
 
             # if the vulnerability type is a privilege escalation
             # and if the escalation level is not already reached on that node,
             # then add the escalation tag to the node properties
-            if isinstance(outcome, model.PrivilegeEscalation):
+            kind = outcome_kind(type(outcome), REWARD_OUTCOMES)
+            if kind is model.PrivilegeEscalation:
                 if outcome.tag in node_info.properties:
-                    reward += Penalty.REPEAT
+                    reward += repeat_penalty
                 else:
                     last_owned_at, _ = self.__mark_node_as_owned(node_id, outcome.level, propagate=False)
                     if not last_owned_at:
                         reward += float(node_info.value)
+                    # the escalation tag is added to the node properties only when committing the outcome
 
-                    # TOCHECK Here should be also new properties count
-                    node_info.properties.append(outcome.tag)
-
-            elif isinstance(outcome, model.LateralMove):
+            elif kind is model.LateralMove:
                 last_owned_at, _ = self.__mark_node_as_owned(node_id, propagate=False)
                 if not last_owned_at:
                     reward += float(node_info.value)
 
-            elif isinstance(outcome, model.CustomerData):
+            elif kind is model.CustomerData:
                 reward += outcome.reward
 
-            elif isinstance(outcome, model.DetectionPoint):
-                reward += Penalty.DECEPTION_PENALTY_FOR_AGENT
+            elif kind is model.DetectionPoint:
+                reward += deception_penalty
 
             # Dummy update all entites, for reward evaluation
             newly_discovered_nodes, \
@@ -561,157 +647,80 @@ class AgentActions:
                 newly_discovered_profiles, ip_local_change = self.__mark_discovered_entities(node_id, outcome, propagate=False)
 
             if isinstance(outcome, model.ProbeSucceeded):
-                only_global_properties = set(outcome.discovered_properties).intersection(self._environment.identifiers.global_properties)
-
-                for p in outcome.discovered_properties:
-                    assert p in node_info.properties or p in self._environment.identifiers.global_properties, \
-                        f'Discovered property {p} must belong to the set of properties associated with the node or global properties.'
+                assert self._global_properties.union(node_info.properties).issuperset(outcome.discovered_properties), \
+                    f'Discovered properties {set(outcome.discovered_properties) - self._global_properties.union(node_info.properties)} ' \
+                    'must belong to the set of properties associated with the node or global properties.'
 
                 newly_discovered_properties += self.__mark_nodeproperties_as_discovered(node_id, outcome.discovered_properties, propagate=False)
-                for discovered_node_id in self._discovered_nodes:
-                    self.__mark_nodeproperties_as_discovered(discovered_node_id, only_global_properties, propagate=False)
-
-            # TOCHECK should be never true, as once we discover node_id, we should input it,
-            # if target_node_id is not inside desicovered_nodes yet,
-            # 1) action_mask, shoudl have excluded it 2) exploit_remote_vulnerability excludes it
 
-            already_executed = False
-            if node_id in self._discovered_nodes:
-                lookup_key = (vulnerability_id, local_or_remote, precondition, True)
-                already_executed = lookup_key in self._discovered_nodes[node_id].last_attack
-
-            if already_executed:
-                last_time = self._discovered_nodes[node_id].last_attack[lookup_key]
-                if node_info.last_reimaging is None or last_time >= node_info.last_reimaging:
-                    if max_reward <= Penalty.REPEAT - vulnerability.cost:
-                        error_type_list.append(ErrorType.REPEATED)
-                        max_precondition_index_list.append(precondition_index)
-                        max_reward_list.append(Penalty.REPEAT - vulnerability.cost)
-                        max_outcome_list.append(outcome)
-                    continue
-            elif not isinstance(outcome, model.ExploitFailed):
-                reward += Reward.NEW_SUCCESSFULL_ATTACK_REWARD
+            if last_attack_time is None and not isinstance(outcome, model.ExploitFailed):
+                reward += new_attack_reward
 
             if not self.__ip_local and ip_local_change:
-                reward += Reward.IP_CHANGE_TO_IP_LOCAL
+                reward += ip_local_reward
 
             # Note: `discovered_nodes_value` should not be added to the reward
             # unless the discovered nodes got owned, but this case is already covered above
-            reward += newly_discovered_nodes * Reward.NODE_DISCOVERED_REWARD
-            reward += newly_discovered_credentials * Reward.CREDENTIAL_DISCOVERED_REWARD
-            reward += newly_discovered_profiles * Reward.PROFILE_DISCOVERED_REWARD
-            reward += newly_discovered_properties * Reward.PROPERTY_DISCOVERED_REWARD
+            reward += discovery_reward(newly_discovered_nodes, newly_discovered_credentials, newly_discovered_profiles, newly_discovered_properties)
 
-            if "ip.local" in str(precondition.expression) and ip_local_flag:
-                reward += Reward.SSRF
+            if precondition.needs_ip_local and ip_local_flag:
+                reward += ssrf_reward
 
-            if max_reward <= reward:
+            keep, tie_count = keep_best_candidate(reward, max_reward, tie_count)
+            if keep:
                 # print(newly_discovered_nodes, newly_discovered_credentials, newly_discovered_profiles, reward)
-                error_type_list.append(ErrorType.NOERROR)
-                max_reward_list.append(reward)
-                max_precondition_index_list.append(precondition_index)
-                max_outcome_list.append(outcome)  # vulnerability.outcome[max_precondition_index] if isinstance(vulnerability.outcome, list) else vulnerability.outcome
-
-            max_reward = max(max_reward_list)
+                max_reward, max_outcome, error_type, max_precondition_index = reward, outcome, ErrorType.NOERROR, precondition_index
 
-        ind_max_reward_candidates = np.argwhere(max_reward_list == np.amax(max_reward_list)).flatten()
-        ind_max_reward = np.random.choice(ind_max_reward_candidates)
-        max_reward, max_outcome, error_type, max_precondition_index = max_reward_list[ind_max_reward], max_outcome_list[ind_max_reward], \
-            error_type_list[ind_max_reward], max_precondition_index_list[ind_max_reward]
         # max_outcome = vulnerability.outcome[max_precondition_index] if isinstance(vulnerability.outcome, list) else vulnerability.outcome
         max_reward_string = vulnerability.reward_string[max_precondition_index] if isinstance(vulnerability.reward_string, list) else vulnerability.reward_string
         max_precondition = vulnerability.precondition[max_precondition_index] if isinstance(vulnerability.precondition, list) else vulnerability.precondition
-        if len(ind_max_reward_candidates) > 1:
-            logger.warning(f"\tChoosing candidate max_reward with node {node_id} precondition  {str(max_precondition.expression)} among other preconditions indices {ind_max_reward_candidates}")
+        if tie_count > 1:
+            logger.warning("\tChoosing candidate max_reward with node %s precondition  %s among %d preconditions with the same reward",
+                           node_id, max_precondition.expression_str, tie_count)
 
         if error_type != ErrorType.NOERROR:  # ver2: error_type == ErrorType.NOERROR ver3: max_reward < 0
             if error_type != ErrorType.REPEATED:
-                lookup_key = (vulnerability_id, local_or_remote, max_precondition, False)
-
-                already_executed = node_id in self._discovered_nodes and lookup_key in self._discovered_nodes[node_id].last_attack
-                if already_executed:
-                    last_time = self._discovered_nodes[node_id].last_attack[lookup_key]
-                    if node_info.last_reimaging is None or last_time >= node_info.last_reimaging:
-                        error_type = ErrorType.REPEATED
-                        max_reward -= Penalty.REPEAT
-
-            logger.warning((error_string_dict[error_type] + " => " + logger_action).format(max_reward, vulnerability_id, node_id, str(profile), str(max_precondition.expression),
-                                                                                           max_reward_string, need_doctor * "doctors or " + (need_doctor + need_chemist) * "chemists"))
+                last_time = node_last_attack.get((vulnerability_id, local_or_remote, max_precondition.uid, False))
+                if last_time is not None and (node_info.last_reimaging is None or last_time >= node_info.last_reimaging):
+                    error_type = ErrorType.REPEATED
+                    max_reward -= repeat_penalty
+
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning(_ERROR_STRINGS[error_type].format(max_reward, vulnerability_id, node_id, str(profile), max_precondition.expression_str,
+                                                                 max_reward_string, need_doctor * "doctors or " + (need_doctor + need_chemist) * "chemists"))
             return False, ActionResult(reward=max_reward, outcome=max_outcome, profile=profile,
                                        precondition=max_precondition, reward_string=max_reward_string)
 
-        logger.info(logger_action.format(max_reward, vulnerability_id, node_id, str(profile), str(max_precondition.expression), max_reward_string))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(_LOGGER_ACTION_FMT.format(max_reward, vulnerability_id, node_id, str(profile), max_precondition.expression_str, max_reward_string))
 
-        reward = -vulnerability.cost
-        if isinstance(max_outcome, model.PrivilegeEscalation):
-            if max_outcome.tag in node_info.properties:
-                reward += Penalty.REPEAT
-            else:
-                last_owned_at, is_currently_owned = self.__mark_node_as_owned(node_id, max_outcome.level)
-                if not last_owned_at:
-                    reward += float(node_info.value)
+        # commit the chosen outcome, its reward max_reward was already computed while previewing it above
+        kind = outcome_kind(type(max_outcome), REWARD_OUTCOMES)
+        if kind is model.PrivilegeEscalation:
+            if max_outcome.tag not in node_info.properties:
+                self.__mark_node_as_owned(node_id, max_outcome.level)
                 node_info.properties.append(max_outcome.tag)
 
-        elif isinstance(max_outcome, model.LateralMove):
-            last_owned_at, is_currently_owned = self.__mark_node_as_owned(node_id)
-            if not last_owned_at:
-                reward += float(node_info.value)
-
-        elif isinstance(outcome, model.CustomerData):
-            reward += outcome.reward
+        elif kind is model.LateralMove:
+            self.__mark_node_as_owned(node_id)
 
-        elif isinstance(max_outcome, model.DetectionPoint):
-            reward += Penalty.DECEPTION_PENALTY_FOR_AGENT
-
-            # Update all entites
-        newly_discovered_nodes, \
-            discovered_nodes_value, \
-            newly_discovered_properties, \
-            newly_discovered_credentials, \
-            newly_discovered_profiles, ip_local_change = self.__mark_discovered_entities(node_id, max_outcome)
+        # Update all entites
+        *_, ip_local_change = self.__mark_discovered_entities(node_id, max_outcome)
 
         if isinstance(max_outcome, model.ProbeSucceeded):
-            only_global_properties = set(max_outcome.discovered_properties).intersection(self._environment.identifiers.global_properties)
-
-            for p in max_outcome.discovered_properties:
-                assert p in node_info.properties or p in self._environment.identifiers.global_properties, \
-                    f'Discovered property {p} must belong to the set of properties associated with the node or global properties.'
-
-            newly_discovered_properties += self.__mark_nodeproperties_as_discovered(node_id, outcome.discovered_properties)
-            for discovered_node_id in self._discovered_nodes:
-                self.__mark_nodeproperties_as_discovered(discovered_node_id, only_global_properties)
-
-        already_executed = False
-        if node_id in self._discovered_nodes:
-            lookup_key = (vulnerability_id, local_or_remote, max_precondition, True)
-            already_executed = lookup_key in self._discovered_nodes[node_id].last_attack
+            self.__mark_nodeproperties_as_discovered(node_id, max_outcome.discovered_properties)
+            self.__mark_global_properties_as_discovered(max_outcome.discovered_properties)
 
-        if already_executed:
-            last_time = self._discovered_nodes[node_id].last_attack[lookup_key]
-            if node_info.last_reimaging is None or last_time >= node_info.last_reimaging:
-                # should not come to REPEAT
-                pass
-        elif not isinstance(outcome, model.ExploitFailed):
-            reward += Reward.NEW_SUCCESSFULL_ATTACK_REWARD
-
-        self._discovered_nodes[node_id].last_attack[lookup_key] = datetime.now()
+        # a repeated attack never gets here, it got the REPEAT penalty among the preconditions
+        self._discovered_nodes[node_id].last_attack[(vulnerability_id, local_or_remote, max_precondition.uid, True)] = datetime.now()
 
         if ip_local_change:
             self.__ip_local = True
-            reward += Reward.IP_CHANGE_TO_IP_LOCAL
             logger.info("Gained access to local network (possible to exploit SSRF)!")
 
-        reward += newly_discovered_nodes * Reward.NODE_DISCOVERED_REWARD
-        reward += newly_discovered_credentials * Reward.CREDENTIAL_DISCOVERED_REWARD
-        reward += newly_discovered_profiles * Reward.PROFILE_DISCOVERED_REWARD
-        reward += newly_discovered_properties * Reward.PROPERTY_DISCOVERED_REWARD
-
-        if "ip.local" in str(max_precondition.expression) and ip_local_flag:
-            reward += Reward.SSRF
+        if max_precondition.needs_ip_local and ip_local_flag:
             logger.info("Exploiting SSRF for access to endpoints through local network!")
 
-        assert reward == max_reward, f'{reward} and {max_reward}, action {node_id} {str(max_precondition.expression)} {str(type(max_outcome))}'
-
         return True, ActionResult(reward=max_reward, outcome=max_outcome, profile=profile,
                                   precondition=max_precondition, reward_string=max_reward_string)
 
@@ -801,10 +810,10 @@ class AgentActions:
                 if rule.permission == model.RulePermission.ALLOW:
                     return True
                 else:
-                    logger.debug(f'BLOCKED TRAFFIC - PORT \'{port_name}\' Reason: ' + rule.reason)
+                    logger.debug("BLOCKED TRAFFIC - PORT '%s' Reason: %s", port_name, rule.reason)
                     return False
 
-        logger.debug(f"BLOCKED TRAFFIC - PORT '{port_name}' - Reason: no rule defined for this port.")
+        logger.debug("BLOCKED TRAFFIC - PORT '%s' - Reason: no rule defined for this port.", port_name)
         return False
 
     def __is_node_owned_history(self, target_node_id, target_node_data):
@@ -856,32 +865,28 @@ class AgentActions:
                 return ActionResult(reward=Penalty.INVALID_ACTION, outcome=None)
 
         if not self.__is_passing_firewall_rules(source_node.firewall.outgoing, port_name):
-            logger.info(f"BLOCKED TRAFFIC: source node '{source_node_id}'" +
-                        f" is blocking outgoing traffic on port '{port_name}'")
+            logger.info("BLOCKED TRAFFIC: source node '%s' is blocking outgoing traffic on port '%s'", source_node_id, port_name)
             return ActionResult(reward=Penalty.BLOCKED_BY_LOCAL_FIREWALL,
                                 outcome=None)
 
         if not self.__is_passing_firewall_rules(target_node.firewall.incoming, port_name):
-            logger.info(f"BLOCKED TRAFFIC: target node '{target_node_id}'" +
-                        f" is blocking outgoing traffic on port '{port_name}'")
+            logger.info("BLOCKED TRAFFIC: target node '%s' is blocking outgoing traffic on port '%s'", target_node_id, port_name)
             return ActionResult(reward=Penalty.BLOCKED_BY_REMOTE_FIREWALL,
                                 outcome=None)
 
-        target_node_is_listening = port_name in [i.name for i in target_node.services]
+        target_node_is_listening = any(service.name == port_name for service in target_node.services)
         if not target_node_is_listening:
-            logger.info(f"target node '{target_node_id}' not listening on port '{port_name}'")
+            logger.info("target node '%s' not listening on port '%s'", target_node_id, port_name)
             return ActionResult(reward=Penalty.SCANNING_UNOPEN_PORT,
                                 outcome=None)
         else:
-            target_node_data: model.NodeInfo = self._environment.get_node(target_node_id)
-
-            if target_node_data.status != model.MachineStatus.Running:
+            if target_node.status != model.MachineStatus.Running:
                 logger.info("target machine not in running state")
                 return ActionResult(reward=Penalty.MACHINE_NOT_RUNNING,
                                     outcome=None)
 
             # check the credentials before connecting
-            if not self._check_service_running_and_authorized(target_node_data, port_name, credential):
+            if not self._check_service_running_and_authorized(target_node, port_name, credential):
                 logger.info("invalid credentials supplied")
                 return ActionResult(reward=Penalty.WRONG_PASSWORD,
                                     outcome=None)
@@ -896,12 +901,11 @@ class AgentActions:
 
             self.__annotate_edge(source_node_id, target_node_id, EdgeAnnotation.LATERAL_MOVE)
 
-            logger.info(f"Infected node '{target_node_id}' from '{source_node_id}'" +
-                        f" via {port_name} with credential '{credential}'")
+            logger.info("Infected node '%s' from '%s' via %s with credential '%s'", target_node_id, source_node_id, port_name, credential)
             if target_node.owned_string:
-                logger.info("Owned message: " + target_node.owned_string)
+                logger.info("Owned message: %s", target_node.owned_string)
 
-            return ActionResult(reward=float(target_node_data.value) if last_owned_at is None else 0.0,
+            return ActionResult(reward=float(target_node.value) if last_owned_at is None else 0.0,
                                 outcome=model.LateralMove())
 
     def _check_service_running_and_authorized(self,
@@ -919,11 +923,10 @@ class AgentActions:
 
     def list_nodes(self) -> List[DiscoveredNodeInfo]:
         """Returns the list of nodes ID that were discovered or owned by the attacker."""
-        return [cast(DiscoveredNodeInfo, {'id': node_id,
-                                          'status': 'owned' if node_info.agent_installed else 'discovered'
-                                          })
-                for node_id, node_info in self.discovered_nodes()
-                ]
+        # ownership is read from the node itself: the defender clears agent_installed when re-imaging
+        get_node = self._environment.get_node
+        return [DiscoveredNodeInfo(id=node_id, status='owned' if get_node(node_id).agent_installed else 'discovered')
+                for node_id in self._discovered_nodes]
 
     def list_remote_attacks(self, node_id: model.NodeID) -> List[model.VulnerabilityID]:
         """Return list of all remote attacks that may be executed onto the specified node."""
@@ -945,29 +948,29 @@ class AgentActions:
 
     def list_all_attacks(self) -> List[Dict[str, object]]:
         """List all possible attacks from all the nodes currently owned by the attacker"""
-        iter_profiles = iter(self._gathered_profiles)
-        on_owned_nodes: List[Dict[str, object]] = [
-            {'id': n['id'],
-             'internal index': i,
-             'status': n['status'],
-             'properties': self._environment.get_node(n['id']).properties,
-             'discovered node properties': list(map(self._environment.identifiers.properties.__getitem__, self.get_discovered_properties(n['id']))),
-             'local_attacks': self.list_local_attacks(n['id']),
-             'remote_attacks': self.list_remote_attacks(n['id']),
-             'gathered_credentials': self._gathered_credentials,
-             'discovered profiles': next(iter_profiles, "")
-             }
-            for i, n in enumerate(self.list_nodes()) if n['status'] == 'owned']
-        on_discovered_nodes: List[Dict[str, object]] = [{'id': n['id'],
-                                                         'internal index': i,
-                                                        'status': n['status'],
-                                                         'properties': self._environment.get_node(n['id']).properties,
-                                                         'discovered node properties': list(map(self._environment.identifiers.properties.__getitem__, self.get_discovered_properties(n['id']))),
-                                                         'local_attacks': None,
-                                                         'remote_attacks': self.list_remote_attacks(n['id']),
-                                                         'gathered_credentials': self._gathered_credentials,
-                                                         'discovered profiles': next(iter_profiles, "")}
-                                                        for i, n in enumerate(self.list_nodes()) if n['status'] != 'owned']
+        indexed_nodes = list(enumerate(self.list_nodes()))
+        owned = [(i, n) for i, n in indexed_nodes if n['status'] == 'owned']
+        other = [(i, n) for i, n in indexed_nodes if n['status'] != 'owned']
+        # profiles are paired with owned nodes first, then with the remaining nodes, "" once exhausted
+        profiles = itertools.chain(self._gathered_profiles.values(), itertools.repeat(""))
+        get_node, property_names = self._environment.get_node, self._environment.identifiers.properties
+
+        def attack_entry(i: int, n: DiscoveredNodeInfo, profile, local_attacks) -> Dict[str, object]:
+            node_id = n['id']
+            return {'id': node_id,
+                    'internal index': i,
+                    'status': n['status'],
+                    'properties': get_node(node_id).properties,
+                    'discovered node properties': [property_names[index] for index in self._discovered_nodes[node_id].discovered_properties],
+                    'local_attacks': local_attacks,
+                    'remote_attacks': self.list_remote_attacks(node_id),
+                    'gathered_credentials': self._gathered_credentials,
+                    'discovered profiles': profile}
+
+        on_owned_nodes = [attack_entry(i, n, profile, self.list_local_attacks(n['id']))
+                          for (i, n), profile in zip(owned, profiles)]
+        on_discovered_nodes = [attack_entry(i, n, profile, None)
+                               for (i, n), profile in zip(other, profiles)]
         return on_owned_nodes + on_discovered_nodes
 
     def print_all_attacks(self, filename=None) -> None:
@@ -985,22 +988,48 @@ class DefenderAgentActions:
     REIMAGING_DURATION = 15
 
     def __init__(self, environment: model.Environment):
-        # map nodes being reimaged to the remaining number of steps to completion
-        self.node_reimaging_progress: Dict[model.NodeID, int] = dict()
-
         # Last calculated availability of the network
         self.__network_availability: float = 1.0
 
         self._environment = environment
 
+        # SLA weights of the nodes and of their services, with the weight of running services
+        # and the running status of each node, updated by the defender actions changing them
+        self._node_index: Dict[model.NodeID, int] = {}
+        for i, (node_id, _) in enumerate(environment.nodes()):
+            self._node_index[node_id] = i
+        self._node_ids: List[model.NodeID] = list(self._node_index)
+        node_count = len(self._node_index)
+        # remaining number of steps to completion of the nodes being reimaged, -1 for the other nodes
+        self._reimaging_steps_left = np.full(node_count, -1, dtype=np.int32)
+        self._node_sla_weights = np.zeros(node_count)
+        self._total_service_weights = np.zeros(node_count)
+        self._running_service_weights = np.zeros(node_count)
+        self._node_running = np.zeros(node_count, dtype=bool)
+        for node_id, node_info in environment.nodes():
+            i = self._node_index[node_id]
+            self._node_sla_weights[i] = node_info.sla_weight
+            self._total_service_weights[i] = sum(service.sla_weight for service in node_info.services)
+            self.__update_node_availability(node_id, node_info)
+
+    def __update_node_availability(self, node_id: model.NodeID, node_info: model.NodeInfo) -> None:
+        i = self._node_index[node_id]
+        self._running_service_weights[i] = sum(service.sla_weight for service in node_info.services if service.running)
+        self._node_running[i] = node_info.status == MachineStatus.Running
+
     @ property
     def network_availability(self):
         return self.__network_availability
 
+    @ property
+    def node_reimaging_progress(self) -> Dict[model.NodeID, int]:
+        """Map nodes being reimaged to the remaining number of steps to completion"""
+        return {self._node_ids[i]: int(self._reimaging_steps_left[i]) for i in np.flatnonzero(self._reimaging_steps_left >= 0)}
+
     def reimage_node(self, node_id: model.NodeID):
         """Re-image a computer node"""
         # Mark the node for re-imaging and make it unavailable until re-imaging completes
-        self.node_reimaging_progress[node_id] = self.REIMAGING_DURATION
+        self._reimaging_steps_left[self._node_index[node_id]] = self.REIMAGING_DURATION
 
         node_info = self._environment.get_node(node_id)
         assert node_info.reimagable, f'Node {node_id} is not re-imageable'
@@ -1010,39 +1039,27 @@ class DefenderAgentActions:
         node_info.status = model.MachineStatus.Imaging
         node_info.last_reimaging = datetime.now()
         self._environment.network.nodes[node_id].update({'data': node_info})
+        self.__update_node_availability(node_id, node_info)
 
     def on_attacker_step_taken(self):
         """Function to be called each time a step is take in the simulation"""
-        for node_id in list(self.node_reimaging_progress.keys()):
-            remaining_steps = self.node_reimaging_progress[node_id]
-            if remaining_steps > 0:
-                self.node_reimaging_progress[node_id] -= 1
-            else:
-                logger.info(f"Machine re-imaging completed: {node_id}")
-                node_data = self._environment.get_node(node_id)
-                node_data.status = model.MachineStatus.Running
-                self.node_reimaging_progress.pop(node_id)
+        steps_left = self._reimaging_steps_left
+        completed = np.flatnonzero(steps_left == 0)
+        steps_left[steps_left > 0] -= 1
+        for i in completed:
+            node_id = self._node_ids[i]
+            logger.info("Machine re-imaging completed: %s", node_id)
+            node_data = self._environment.get_node(node_id)
+            node_data.status = model.MachineStatus.Running
+            steps_left[i] = -1
+            self.__update_node_availability(node_id, node_data)
 
         # Calculate the network availability metric based on machines
         # and services that are running
-        total_node_weights = 0
-        network_node_availability = 0
-        for node_id, node_info in self._environment.nodes():
-            total_service_weights = 0
-            running_service_weights = 0
-            for service in node_info.services:
-                total_service_weights += service.sla_weight
-                running_service_weights += service.sla_weight * int(service.running)
-
-            if node_info.status == MachineStatus.Running:
-                adjusted_node_availability = (1 + running_service_weights) / (1 + total_service_weights)
-            else:
-                adjusted_node_availability = 0.0
-
-            total_node_weights += node_info.sla_weight
-            network_node_availability += adjusted_node_availability * node_info.sla_weight
-
-        self.__network_availability = network_node_availability / total_node_weights
+        adjusted_node_availability = np.where(self._node_running,
+                                              (1 + self._running_service_weights) / (1 + self._total_service_weights),
+                                              0.0)
+        self.__network_availability = float((adjusted_node_availability * self._node_sla_weights).sum() / self._node_sla_weights.sum())
         assert (self.__network_availability <= 1.0 and self.__network_availability >= 0.0)
 
     def override_firewall_rule(self, node_id: model.NodeID, port_name: model.PortName, incoming: bool, permission: model.RulePermission):
@@ -1079,6 +1096,7 @@ class DefenderAgentActions:
         for service in node_data.services:
             if service.name == port_name:
                 service.running = False
+        self.__update_node_availability(node_id, node_data)
 
     def start_service(self, node_id: model.NodeID, port_name: model.PortName):
         node_data = self._environment.get_node(node_id)
@@ -1086,3 +1104,4 @@ class DefenderAgentActions:
         for service in node_data.services:
             if service.name == port_name:
                 service.running = True
+        self.__update_node_availability(node_id, node_data)
@@ -5,6 +5,9 @@
     This is the set of tests for actions.py which implements the actions an agent can take
     in this simulation.
 """
+import copy
+import dataclasses
+import pickle
 import random
 from datetime import datetime
 from typing import Dict, List
@@ -227,6 +230,71 @@ def actions_on_simple_environment() -> actions.AgentActions:
     return actions.AgentActions(env)
 
 
+@ pytest.fixture
+def actions_on_discovery_environment() -> actions.AgentActions:
+    """
+     This fixture will provide us with an environment where the owned node 'a'
+     reveals the other nodes, a credential or the global property 'GlobalSecret'
+    """
+    nodes = {
+        'a': model.NodeInfo(
+            services=[],
+            value=10,
+            properties=["Windows"],
+            vulnerabilities=dict(
+                ProbeGlobal=model.VulnerabilityInfo(
+                    description="reveal a property shared by all nodes",
+                    type=model.VulnerabilityType.LOCAL,
+                    outcome=model.ProbeSucceeded(discovered_properties=["GlobalSecret"])),
+                ListB=model.VulnerabilityInfo(
+                    description="reveal node b",
+                    type=model.VulnerabilityType.LOCAL,
+                    outcome=model.LeakedNodesId(discovered_nodes=['b'])),
+                ListC=model.VulnerabilityInfo(
+                    description="reveal node c",
+                    type=model.VulnerabilityType.LOCAL,
+                    outcome=model.LeakedNodesId(discovered_nodes=['c'])),
+                ListDC=model.VulnerabilityInfo(
+                    description="reveal node dc",
+                    type=model.VulnerabilityType.LOCAL,
+                    outcome=model.LeakedNodesId(discovered_nodes=['dc'])),
+                LeakCredentialsOrNodes=model.VulnerabilityInfo(
+                    description="leak a credential to dc, or reveal nodes b and c",
+                    type=model.VulnerabilityType.LOCAL,
+                    precondition=[model.Precondition("Windows"), model.Precondition("Windows")],
+                    outcome=[model.LeakedCredentials(credentials=[model.CachedCredential('dc', "RDP", "dcpass")]),
+                             model.LeakedNodesId(discovered_nodes=['b', 'c'])])
+            ),
+            agent_installed=True),
+        'b': model.NodeInfo(services=[model.ListeningService("SSH")], value=20, properties=["Linux"]),
+        'c': model.NodeInfo(services=[model.ListeningService("RDP")], value=30, properties=["Windows"]),
+        'dc': model.NodeInfo(
+            services=[model.ListeningService("RDP", allowedCredentials=["dcpass"])],
+            value=50,
+            properties=["Windows", "PortRDPOpen"],
+            vulnerabilities=dict(
+                RemoteAdmin=model.VulnerabilityInfo(
+                    description="remote exploit running as administrator",
+                    type=model.VulnerabilityType.REMOTE,
+                    precondition=model.Precondition("Windows"),
+                    outcome=model.AdminEscalation())
+            ))
+    }
+    env = model.Environment(network=model.create_network(nodes),
+                            version=model.VERSION_TAG,
+                            vulnerability_library=dict([]),
+                            identifiers=model.Identifiers(
+                                properties=["Windows", "Linux", "PortRDPOpen", "GlobalSecret"],
+                                ports=["RDP", "SSH"],
+                                local_vulnerabilities=["ProbeGlobal", "ListB", "ListC", "ListDC", "LeakCredentialsOrNodes"],
+                                remote_vulnerabilities=["RemoteAdmin"],
+                                initial_properties=["Windows", "Linux"],
+                                global_properties=["GlobalSecret"]),
+                            creationTime=datetime.utcnow(),
+                            lastModified=datetime.utcnow())
+    return actions.AgentActions(env)
+
+
 def test_list_vulnerabilities_function(actions_on_single_node_environment: Fixture,
                                        actions_on_simple_environment: Fixture) -> None:
     """
@@ -376,3 +444,201 @@ def test_check_prerequisites(actions_on_simple_environment: Fixture) -> None:
     # testing on a node/vuln combo which should give us a positive reuslt.
     result = actions_on_simple_environment._check_prerequisites('dc', SAMPLE_VULNERABILITIES["UACME61"])
     assert result
+
+
+def test_keep_best_candidate(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Candidates tied at the maximum reward are kept by reservoir sampling over np.random"""
+    def best_candidate(draw: float) -> int:
+        monkeypatch.setattr(actions.np.random, "random", lambda: draw)
+        max_reward, tie_count, best = -1.0, 0, -1
+        for index, reward in enumerate([1.0, 3.0, 2.0, 3.0]):
+            keep, tie_count = actions.keep_best_candidate(reward, max_reward, tie_count)
+            if keep:
+                max_reward, best = reward, index
+        assert max_reward == 3.0 and tie_count == 2
+        return best
+
+    # the second tied candidate replaces the first one with probability 1/2
+    assert best_candidate(0.49) == 3
+    assert best_candidate(0.5) == 1
+
+
+def test_global_properties_marked_on_discovered_nodes(actions_on_discovery_environment: Fixture) -> None:
+    """A probed global property is marked on the nodes discovered so far,
+    and nodes discovered afterwards start with it"""
+    property_index = actions_on_discovery_environment._environment.identifiers.properties.index
+    actions_on_discovery_environment.exploit_local_vulnerability('a', "ListB")
+    actions_on_discovery_environment.exploit_local_vulnerability('a', "ProbeGlobal")
+    actions_on_discovery_environment.exploit_local_vulnerability('a', "ListC")
+
+    assert property_index("GlobalSecret") in actions_on_discovery_environment.get_discovered_properties('a')
+    assert actions_on_discovery_environment.get_discovered_properties('b') == {property_index("Linux"), property_index("GlobalSecret")}
+    assert actions_on_discovery_environment.get_discovered_properties('c') == {property_index("Windows"), property_index("GlobalSecret")}
+
+
+
+
+def test_remote_privilege_escalation(actions_on_discovery_environment: Fixture) -> None:
+    """A successful remote privilege escalation owns the target at the escalated level
+    and tags its properties once"""
+    actions_on_discovery_environment.exploit_local_vulnerability('a', "ListDC")
+
+    result = actions_on_discovery_environment.exploit_remote_vulnerability('a', 'dc', model.Profile(username="NoAuth"), "RemoteAdmin")
+    assert isinstance(result.outcome, model.AdminEscalation)
+    node: model.NodeInfo = actions_on_discovery_environment._environment.get_node('dc')
+    assert node.agent_installed
+    assert node.privilege_level == model.PrivilegeLevel.Admin
+    assert node.properties.count(ADMINTAG) == 1
+
+    # repeating the exploit does not tag the node again
+    actions_on_discovery_environment.exploit_remote_vulnerability('a', 'dc', model.Profile(username="NoAuth"), "RemoteAdmin")
+
+
+    assert node.properties.count(ADMINTAG) == 1
+
+
+def test_outcome_preview_has_no_side_effect(actions_on_discovery_environment: Fixture) -> None:
+    """Only the outcome of the winning precondition is applied: leaking the credential to dc
+    earns less than revealing nodes b and c, so dc stays undiscovered"""
+    result = actions_on_discovery_environment.exploit_local_vulnerability('a', "LeakCredentialsOrNodes")
+    assert isinstance(result.outcome, model.LeakedNodesId)
+
+    assert actions_on_discovery_environment.is_node_discovered('b')
+    assert actions_on_discovery_environment.is_node_discovered('c')
+    assert not actions_on_discovery_environment.is_node_discovered('dc')
+    assert "dcpass" not in actions_on_discovery_environment._gathered_credentials
+
+    # cost, first successful attack, then 2 new nodes each with 1 new initial property
+    assert result.reward == -1.0 + actions.Reward.NEW_SUCCESSFULL_ATTACK_REWARD + \
+        2 * actions.Reward.NODE_DISCOVERED_REWARD + 2 * actions.Reward.PROPERTY_DISCOVERED_REWARD
+
+
+def test_with_slots_dataclasses() -> None:
+    """Dataclasses rebuilt by `with_slots` keep their defaults, equality and pickling, and drop the instance `__dict__`"""
+    for cls in [actions.ActionResult, actions.NodeTrackingInformation]:
+        assert dataclasses.is_dataclass(cls)
+        assert cls.__slots__ == tuple(field.name for field in dataclasses.fields(cls))
+
+    result = actions.ActionResult(reward=1.0)
+    assert (result.outcome, result.precondition, result.profile, result.reward_string) == (None, "", "", "")
+    assert not hasattr(result, '__dict__')
+    with pytest.raises(AttributeError):
+        result.unknown_field = 0  # type: ignore
+
+    # mutable defaults are still created per instance
+    first, second = actions.NodeTrackingInformation(), actions.NodeTrackingInformation()
+    first.discovered_properties.add(0)
+    first.last_attack[('vuln', True, 0, True)] = datetime.now()
+    assert second.discovered_properties == set() and second.last_attack == {}
+    assert first != second
+    assert actions.NodeTrackingInformation(discovered_properties={0}) == actions.NodeTrackingInformation(discovered_properties={0})
+
+    for instance in [actions.ActionResult(reward=2.0, reward_string="escalated"), first]:
+        restored = pickle.loads(pickle.dumps(instance))
+        assert restored == instance
+        assert type(restored) is type(instance)
+    assert copy.deepcopy(first) == first
+
+
+def test_evaluate_precondition_profile_errors(actions_on_discovery_environment: Fixture) -> None:
+    """A profile failing a precondition only for lack of roles gets ROLES_WRONG,
+    otherwise the error tells apart a missing from a wrong authentication"""
+    actions_on_discovery_environment.exploit_local_vulnerability('a', "ListB")
+
+    def evaluate(precondition: str, profile: model.Profile) -> actions.ErrorType:
+        return actions_on_discovery_environment._evaluate_precondition('b', profile, profile.symbols, model.Precondition(precondition), False)
+
+    doctor_only = "username.LisaGWhite&roles.isDoctor&Linux"
+    assert evaluate(doctor_only, model.Profile(username="LisaGWhite", roles={"isDoctor"})) == actions.ErrorType.NOERROR
+    assert evaluate(doctor_only, model.Profile(username="LisaGWhite")) == actions.ErrorType.ROLES_WRONG
+    assert evaluate(doctor_only, model.Profile(username="LisaGWhite", roles={"isChemist"})) == actions.ErrorType.ROLES_WRONG
+    assert evaluate(doctor_only, model.Profile(username="JohnDoe", roles={"isDoctor"})) == actions.ErrorType.WRONG_AUTH
+    assert evaluate(doctor_only, model.Profile(username="NoAuth")) == actions.ErrorType.NO_AUTH
+
+    # every role of the precondition is required
+    both_roles = "username.LisaGWhite&roles.isDoctor&roles.isChemist"
+    assert evaluate(both_roles, model.Profile(username="LisaGWhite", roles={"isDoctor"})) == actions.ErrorType.ROLES_WRONG
+    assert evaluate(both_roles, model.Profile(username="LisaGWhite", roles={"isDoctor", "isChemist"})) == actions.ErrorType.NOERROR
+
+    # the profile is checked before the node properties
+    assert evaluate("username.LisaGWhite&Windows", model.Profile(username="LisaGWhite")) == actions.ErrorType.PROPERTY_WRONG
+    assert evaluate("username.LisaGWhite&Windows", model.Profile(username="NoAuth")) == actions.ErrorType.NO_AUTH
+
+
+def test_nodes_with_atleast_privilegelevel(actions_on_discovery_environment: Fixture) -> None:
+    """Nodes are listed in network order at their current privilege level,
+    which a defender re-imaging a node lowers behind the attacker's back"""
+    environment = actions_on_discovery_environment._environment
+    levels = [model.PrivilegeLevel.NoAccess, model.PrivilegeLevel.LocalUser, model.PrivilegeLevel.Admin, model.PrivilegeLevel.System]
+
+    def nodes_by_level() -> List[List[model.NodeID]]:
+        nodes = [actions_on_discovery_environment.get_nodes_with_atleast_privilegelevel(level) for level in levels]
+        assert nodes == [[node_id for node_id, node in environment.nodes() if node.privilege_level >= level] for level in levels]
+        return nodes
+
+    assert nodes_by_level() == [['a', 'b', 'c', 'dc'], ['a'], [], []]
+
+    actions_on_discovery_environment.exploit_local_vulnerability('a', "ListDC")
+    actions_on_discovery_environment.exploit_remote_vulnerability('a', 'dc', model.Profile(username="NoAuth"), "RemoteAdmin")
+    assert nodes_by_level() == [['a', 'b', 'c', 'dc'], ['a', 'dc'], ['dc'], []]
+
+    actions.DefenderAgentActions(environment).reimage_node('dc')
+    assert nodes_by_level() == [['a', 'b', 'c', 'dc'], ['a'], [], []]
+
+
+def test_defender_network_availability(actions_on_discovery_environment: Fixture) -> None:
+    """The network availability weighs the running nodes by the share of their services still running"""
+    defender = actions.DefenderAgentActions(actions_on_discovery_environment._environment)
+    defender.on_attacker_step_taken()
+    assert defender.network_availability == 1.0
+
+    # b runs one of its 1 + 1 service weights
+    defender.stop_service('b', "SSH")
+    defender.on_attacker_step_taken()
+    assert defender.network_availability == pytest.approx((1 + 0.5 + 1 + 1) / 4)
+
+    # dc is down until re-imaging completes, at the step following the REIMAGING_DURATION ones
+    defender.reimage_node('dc')
+    for _ in range(defender.REIMAGING_DURATION):
+        defender.on_attacker_step_taken()
+        assert defender.network_availability == pytest.approx((1 + 0.5 + 1 + 0) / 4)
+    defender.on_attacker_step_taken()
+    assert defender.network_availability == pytest.approx((1 + 0.5 + 1 + 1) / 4)
+
+    defender.start_service('b', "SSH")
+    defender.on_attacker_step_taken()
+    assert defender.network_availability == 1.0
+
+
+def test_defender_node_reimaging_progress(actions_on_discovery_environment: Fixture) -> None:
+    """The remaining re-imaging steps count down to 0, then the node runs again and leaves the progress map"""
+    environment = actions_on_discovery_environment._environment
+    defender = actions.DefenderAgentActions(environment)
+    assert defender.node_reimaging_progress == {}
+
+    defender.reimage_node('dc')
+    defender.on_attacker_step_taken()
+    defender.reimage_node('b')
+    assert defender.node_reimaging_progress == {'b': defender.REIMAGING_DURATION, 'dc': defender.REIMAGING_DURATION - 1}
+
+    # the property is a snapshot, it cannot be used to change the progress
+    progress = defender.node_reimaging_progress
+    progress['dc'] = 0
+    progress.pop('b')
+    assert defender.node_reimaging_progress == {'b': defender.REIMAGING_DURATION, 'dc': defender.REIMAGING_DURATION - 1}
+    with pytest.raises(AttributeError):
+        defender.node_reimaging_progress = {}  # type: ignore
+
+    for _ in range(defender.REIMAGING_DURATION - 1):
+        defender.on_attacker_step_taken()
+    assert defender.node_reimaging_progress == {'b': 1, 'dc': 0}
+    assert environment.get_node('dc').status == model.MachineStatus.Imaging
+
+    defender.on_attacker_step_taken()
+    assert defender.node_reimaging_progress == {'b': 0}
+    assert environment.get_node('dc').status == model.MachineStatus.Running
+    assert environment.get_node('b').status == model.MachineStatus.Imaging
+
+    defender.on_attacker_step_taken()
+    assert defender.node_reimaging_progress == {}
+    assert environment.get_node('b').status == model.MachineStatus.Running
@@ -56,6 +56,14 @@ class Configuration():
         self.log_dir = os.path.join(log_dir, gymid, datetime_str)
         self.summary_dir = None
         self.log_level = os.getenv("LOG_LEVEL", "info")
+        # opt-in throttling of the periodic detection point checkpoints (taken every time by default): skip one if fewer
+        # triggers were recorded since the previous one, or if the previous one held up training for more than a fraction
+        # of the wall time elapsed since it
+        self.checkpoint_min_new_triggers = int(os.getenv("CHECKPOINT_MIN_NEW_TRIGGERS", 0))
+        max_time_fraction = os.getenv("CHECKPOINT_MAX_TIME_FRACTION")
+        self.checkpoint_max_time_fraction = float(max_time_fraction) if max_time_fraction else None
+        # storage of periodic detection point checkpoints: npz, npz_compressed or npy_dir (one .npy per array)
+        self.detection_dump_format = os.getenv("DETECTION_DUMP_FORMAT", "npz")
         self.writer = None
         self.honeytokens_on = {"HT1_v2tov1": True, "HT2_phonebook": True, "HT3_state": True, "HT4_cloudactivedefense": True}
         if type(self.honeytokens_on) == str:
@@ -24,8 +24,11 @@ formally defined by:
   - FirewallRule: PortName x { ALLOW, BLOCK }
 """
 
+import array
+import functools
+import itertools
 from datetime import datetime, time
-from typing import NamedTuple, List, Dict, OrderedDict, Optional, Union, Tuple, Iterator, Set, get_type_hints
+from typing import NamedTuple, List, Dict, OrderedDict, Optional, Union, Tuple, Iterator, Set, FrozenSet, AbstractSet, Callable, Mapping, get_type_hints
 import dataclasses
 from dataclasses import dataclass, field
 import matplotlib.pyplot as plt  # type:ignore
@@ -114,18 +117,45 @@ class Profile:
     def is_auth_symbol(symbol_str: str) -> bool:
         return Profile.is_profile_symbol(symbol_str) and ('username' in symbol_str or 'id' in symbol_str)
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        # drop the string and symbols computed from the previous field values
+        self.__dict__.pop('_str', None)
+        self.__dict__.pop('_symbols', None)
+
+    def symbol_names(self) -> Iterator[str]:
+        """Names of the symbols conjoined by `__str__`"""
+        for profile_field in dataclasses.fields(self):
+            value = getattr(self, profile_field.name)
+            if isinstance(value, RolesType):
+                yield from (profile_field.name + '.' + str(role) for role in value)
+            elif value is not None:
+                yield profile_field.name + '.' + str(value)
+
+    @property
+    def symbols(self) -> FrozenSet[boolean.Symbol]:
+        """Symbols of `ALGEBRA.parse(str(self))`, built without parsing and kept until a field is set"""
+        symbols = self.__dict__.get('_symbols')
+        if symbols is None:
+            symbols = self.__dict__['_symbols'] = frozenset(map(boolean.Symbol, self.symbol_names()))
+        return symbols
+
     def __str__(self) -> str:
-        return "&".join(filter(None, ("&".join(key + '.' + str(value)
-                                               for key, value in dataclasses.asdict(self).items()
-                                               if value is not None and not isinstance(value, RolesType)),
-                                      "&".join("&".join(key + '.' + str(value) for value in value_list)
-                                               for key, value_list in dataclasses.asdict(self).items()
-                                               if value_list is not None and isinstance(value_list, RolesType)))))
+        profile_str = self.__dict__.get('_str')
+        if profile_str is None:
+            profile_str = self.__dict__['_str'] = \
+                "&".join(filter(None, ("&".join(key + '.' + str(value)
+                                                for key, value in dataclasses.asdict(self).items()
+                                                if value is not None and not isinstance(value, RolesType)),
+                                       "&".join("&".join(key + '.' + str(value) for value in value_list)
+                                                for key, value_list in dataclasses.asdict(self).items()
+                                                if value_list is not None and isinstance(value_list, RolesType)))))
+        return profile_str
 
     def __le__(self, other) -> bool:
-        for k, v in self.__dict__.items():
-            if v is not None:
-                if getattr(self, k) != getattr(other, k):  # if we have this property set, check if it is the same as in other
+        for profile_field in dataclasses.fields(self):
+            if getattr(self, profile_field.name) is not None:
+                if getattr(self, profile_field.name) != getattr(other, profile_field.name):  # if we have this property set, check if it is the same as in other
                     return False
         return True
 
@@ -317,6 +347,49 @@ class AttackResult():
     expected_outcome: Union[VulnerabilityOutcomes, None]
 
 
+def partial_evaluate(expression: boolean.Expression,
+                     fixed: Mapping[boolean.Symbol, bool]) -> Union[bool, Callable[[AbstractSet[boolean.Symbol]], bool]]:
+    """Fold the symbols with a value in `fixed` into the expression. Return the resulting constant,
+    or a function evaluating the remaining expression for the given set of true symbols"""
+    if isinstance(expression, boolean.Symbol):
+        if expression in fixed:
+            return fixed[expression]
+        return lambda true_symbols: expression in true_symbols
+    if isinstance(expression, boolean.BaseElement):
+        return bool(expression)
+    operands = [partial_evaluate(arg, fixed) for arg in expression.args]
+    if isinstance(expression, boolean.NOT):
+        operand = operands[0]
+        if isinstance(operand, bool):
+            return not operand
+        return lambda true_symbols: not operand(true_symbols)
+    if isinstance(expression, (boolean.AND, boolean.OR)):
+        # an absorbing constant decides the whole expression, the neutral ones can be dropped
+        absorbing = isinstance(expression, boolean.OR)
+        if absorbing in operands:
+            return absorbing
+        operands = [operand for operand in operands if not isinstance(operand, bool)]
+        if not operands:
+            return not absorbing
+        if len(operands) == 1:
+            return operands[0]
+        if absorbing:
+            return lambda true_symbols: any(operand(true_symbols) for operand in operands)
+        return lambda true_symbols: all(operand(true_symbols) for operand in operands)
+    raise ValueError(f"Unsupported boolean expression {expression!r}")
+
+
+def compile_expression(expression: boolean.Expression,
+                       fixed: Optional[Mapping[boolean.Symbol, bool]] = None) -> Callable[[AbstractSet[boolean.Symbol]], bool]:
+    """Compile a boolean expression into a function evaluating it for the given set of true symbols
+    (all other symbols are false), with the short-circuiting of Python's `all` and `any`.
+    Symbols with a value in `fixed` are folded in at compile time"""
+    compiled = partial_evaluate(expression, fixed or {})
+    if isinstance(compiled, bool):
+        return lambda true_symbols: compiled
+    return compiled
+
+
 class Precondition:
     """ A predicate logic expression defining the condition under which a given
     feature or vulnerability is present or not.
@@ -327,18 +400,67 @@ class Precondition:
     """
 
     expression: boolean.Expression
+    # unique integer identifier, kept by copies of the environment
+    uid: int
+
+    __uids = itertools.count()
 
     def __init__(self, expression: Union[boolean.Expression, str]):
         if isinstance(expression, boolean.Expression):
             self.expression = expression
         else:
             self.expression = ALGEBRA.parse(expression)
+        self.uid = next(Precondition.__uids)
+
+    # symbol sets of the expression, computed on first use since they are queried on every attack attempt
+
+    @functools.cached_property
+    def symbols(self) -> FrozenSet[boolean.Symbol]:
+        return frozenset(self.expression.get_symbols())
+
+    @functools.cached_property
+    def profile_symbols(self) -> FrozenSet[boolean.Symbol]:
+        return frozenset(symbol for symbol in self.symbols if Profile.is_profile_symbol(str(symbol)))
+
+    @functools.cached_property
+    def role_symbols(self) -> FrozenSet[boolean.Symbol]:
+        return frozenset(symbol for symbol in self.profile_symbols if Profile.is_role_symbol(str(symbol)))
+
+    @functools.cached_property
+    def property_symbols(self) -> FrozenSet[boolean.Symbol]:
+        return self.symbols - self.profile_symbols
+
+    @functools.cached_property
+    def evaluate(self) -> Callable[[AbstractSet[boolean.Symbol]], bool]:
+        """The expression compiled by `compile_expression`"""
+        return compile_expression(self.expression)
+
+    @functools.cached_property
+    def _specialized(self) -> Dict[FrozenSet[boolean.Symbol], Callable[[AbstractSet[boolean.Symbol]], bool]]:
+        return {}
+
+    def specialize(self, true_profile_symbols: AbstractSet[boolean.Symbol]) -> Callable[[AbstractSet[boolean.Symbol]], bool]:
+        """The expression compiled with its profile symbols fixed (true if in `true_profile_symbols`),
+        evaluating only the node properties. Compiled once per distinct assignment of the profile symbols"""
+        key = self.profile_symbols.intersection(true_profile_symbols)
+        if key not in self._specialized:
+            self._specialized[key] = compile_expression(self.expression, {symbol: symbol in key for symbol in self.profile_symbols})
+        return self._specialized[key]
+
+    @functools.cached_property
+    def needs_ip_local(self) -> bool:
+        return any(str(symbol) == 'ip.local' for symbol in self.profile_symbols)
+
+    @functools.cached_property
+    def expression_str(self) -> str:
+        """The expression formatted as a string, used in vulnerability names and logs"""
+        return str(self.expression)
 
     def get_properties(self) -> Set[PropertyName]:
-        return {str(symbol) for symbol in self.expression.get_symbols() if not Profile.is_profile_symbol(str(symbol))}
+        return {str(symbol) for symbol in self.property_symbols}
 
     def need_roles(self):
-        symbols = [str(symbol) for symbol in self.expression.get_symbols()]
+        symbols = [str(symbol) for symbol in self.role_symbols]
         return 'roles.isDoctor' in symbols, 'roles.isChemist' in symbols  # logic: roles are always included WIHTOUT ~(NOT)
 
 
@@ -347,7 +469,14 @@ class DeceptionTracker:
 
     def __init__(self, detection_point_name: str, step=None):
         self.detection_point_name = detection_point_name
-        self.trigger_times = [step] if step is not None else []
+        # unboxed int64 steps, readable as a numpy array without conversion with np.frombuffer
+        self.trigger_times = array.array('q', [step] if step is not None else [])
+        self.trigger_count = len(self.trigger_times)
+
+    def trigger(self, step: int) -> None:
+        """Record that the detection point was triggered at the given step"""
+        self.trigger_times.append(step)
+        self.trigger_count += 1
 
 
 class VulnerabilityInfo(NamedTuple):
@@ -567,12 +696,12 @@ def collect_detection_point_names(nodes: Iterator[Tuple[NodeID, NodeInfo]],
 
 def vuln_name_from_vuln(node_id: NodeID, id: VulnerabilityID, vuln_info: VulnerabilityInfo) -> Set:
     if isinstance(vuln_info.precondition, list):
-        return {":".join([str(node_id), str(precondition.expression), str(id)]) if node_id else
-                ":".join([str(precondition.expression), str(id)])
+        return {":".join([str(node_id), precondition.expression_str, str(id)]) if node_id else
+                ":".join([precondition.expression_str, str(id)])
                 for precondition in vuln_info.precondition}  # (Optional) Omit TRUE in precondition name: if vuln_info.precondition.expression is not Precondition("true").expression else ""])}
     else:
-        return {":".join([str(node_id), str(vuln_info.precondition.expression), str(id)]) if node_id else
-                ":".join([str(vuln_info.precondition.expression), str(id)])}  # (Optional) Omit TRUE in precondition name
+        return {":".join([str(node_id), vuln_info.precondition.expression_str, str(id)]) if node_id else
+                ":".join([vuln_info.precondition.expression_str, str(id)])}  # (Optional) Omit TRUE in precondition name
 
 
 def collect_vulnerability_ids_from_nodes_bytype(
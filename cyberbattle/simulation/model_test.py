@@ -141,3 +141,78 @@ def test_yaml_serialization_vulnerabilitytype() -> None:
 
     object_to_serialize = model.VulnerabilityType.LOCAL
     check_reserializing(object_to_serialize)
+
+
+def reference_evaluate(expression: model.boolean.Expression, true_symbols: set) -> bool:
+    """Evaluate `expression` with boolean.py by substituting every symbol by its truth value"""
+    substitutions = {symbol: model.ALGEBRA.TRUE if symbol in true_symbols else model.ALGEBRA.FALSE
+                     for symbol in expression.get_symbols()}
+    return expression.subs(substitutions, simplify=True) == model.ALGEBRA.TRUE
+
+
+def all_truth_assignments(symbols: list) -> list:
+    return [{symbol for i, symbol in enumerate(symbols) if mask & (1 << i)} for mask in range(1 << len(symbols))]
+
+
+def test_compile_expression() -> None:
+    """Compiled expressions agree with boolean.py on every assignment of their symbols"""
+    for text in ["Windows",
+                 "~Windows",
+                 "Windows&Win10",
+                 "Windows|Linux",
+                 f"Windows&Win10&(~({ADMINTAG}|{SYSTEMTAG}))",
+                 "~(~Windows&Linux)",
+                 "~~Windows",
+                 "(Windows|Linux)&~(Win10&~(Linux|Windows))"]:
+        expression = model.ALGEBRA.parse(text)
+        compiled = model.compile_expression(expression)
+        for true_symbols in all_truth_assignments(sorted(expression.get_symbols())):
+            assert compiled(true_symbols) == reference_evaluate(expression, true_symbols), (text, true_symbols)
+
+
+def test_compile_expression_fixed_symbols() -> None:
+    """Fixed symbols are folded in and ignore the truth set passed at evaluation time"""
+    windows, linux, win10 = model.ALGEBRA.Symbol("Windows"), model.ALGEBRA.Symbol("Linux"), model.ALGEBRA.Symbol("Win10")
+    expression = model.ALGEBRA.parse("Windows&(Win10|~Linux)")
+
+    assert model.partial_evaluate(expression, {windows: False}) is False
+    assert model.partial_evaluate(expression, {windows: True, linux: False}) is True
+    assert model.partial_evaluate(expression, {windows: True, linux: True, win10: False}) is False
+
+    compiled = model.compile_expression(expression, {windows: True})
+    assert compiled(set())
+    assert compiled({linux, win10})
+    assert not compiled({linux})
+    assert model.compile_expression(expression, {windows: False})({windows, win10}) is False
+    assert model.compile_expression(expression, {windows: True, linux: False})(set()) is True
+
+    # without fixed symbols nothing is folded in, regardless of earlier compilations
+    compiled = model.compile_expression(expression)
+    assert not compiled(set())
+    assert compiled({windows})
+    assert not compiled({windows, linux})
+
+
+def test_precondition_specialize() -> None:
+    """Specializing a precondition fixes its profile symbols and caches the result per assignment"""
+    precondition = model.Precondition("Windows&(username.NoAuth|roles.admin)")
+    windows, no_auth, admin = (model.ALGEBRA.Symbol(name) for name in ["Windows", "username.NoAuth", "roles.admin"])
+    assert precondition.profile_symbols == {no_auth, admin}
+    assert precondition.role_symbols == {admin}
+    assert precondition.property_symbols == {windows}
+
+    assert precondition.evaluate({windows, admin})
+    assert not precondition.evaluate({windows})
+    assert not precondition.evaluate({no_auth, admin})
+
+    as_admin = precondition.specialize({admin})
+    assert as_admin({windows})
+    assert not as_admin(set())
+    # symbols absent from the expression do not change the specialization
+    assert precondition.specialize({admin, model.ALGEBRA.Symbol("roles.guest")}) is as_admin
+
+    anonymous = precondition.specialize(set())
+    assert anonymous is not as_admin
+    assert not anonymous({windows})
+    assert not anonymous({windows, admin})
+    assert precondition.specialize({no_auth})({windows})